@@ -258,3 +258,14 @@ void evolve(double ** r, double ** v, double ** a,double * mass, double * eta, i
   COPY(vu,v,N);
   COPY(vu_w,a,N);
 }
+
+void accelerations(double ** r, double ** v, double ** a, double * mass, double * eta, int N) {
+  double ru[N][3],vu[N][3],ro[N][3],vo[N][3];
+
+  COPY(r,ru,N);
+  COPY(v,vu,N);
+
+  rhs(ru,vu,ro,vo,mass,eta,N);
+
+  COPY(vo,a,N);
+}
@@ -17,4 +17,7 @@
 void evolve(double ** r, double ** v, double ** a, double * mass, double * eta, int N,
 	    double time0, double time, double HMAX, int & status, double ORBIT_ERROR, double HLIMIT);
 
+// Fills the NX3 matrix a with the accelerations of the Jacobian coordinates r (velocities v).
+void accelerations(double ** r, double ** v, double ** a, double * mass, double * eta, int N);
+
 #endif
@@ -0,0 +1,121 @@
+#include <math.h>
+#include <thread>
+#include "n_body_dense.h"
+
+using namespace std;
+
+NBodyDense::NBodyDense(NBodyState & state, double tmin, double tmax, double H, double ORBIT_ERROR, double HLIMIT,
+                       double DENSE_ERROR) {
+  N = state.getN();
+  width = 1+9*N;
+
+  vector<double> ms(N), snapshot(1+6*N);
+  for (int i = 0; i < N; i++) ms[i] = state.getMass(i);
+  state.getSnapshot(&snapshot[0]);
+
+  // Both legs start from the current state and are independent
+  vector<double> backward, forward;
+
+  thread behind([&]() {
+    NBodyState st(&ms[0],&snapshot[0],N);
+    leg(st,tmin,H,ORBIT_ERROR,HLIMIT,DENSE_ERROR,backward);
+  });
+
+  NBodyState st(&ms[0],&snapshot[0],N);
+  leg(st,tmax,H,ORBIT_ERROR,HLIMIT,DENSE_ERROR,forward);
+
+  behind.join();
+
+  // Store in ascending time; both legs share their first node
+  int nb = backward.size()/width;
+  nodes.reserve(backward.size()+forward.size());
+  for (int i = nb-1; i > 0; i--)
+    nodes.insert(nodes.end(),backward.begin()+i*width,backward.begin()+(i+1)*width);
+  nodes.insert(nodes.end(),forward.begin(),forward.end());
+}
+
+double * NBodyDense::node(int i) { return &nodes[i*width]; }
+
+int NBodyDense::size() { return nodes.size()/width; }
+
+void NBodyDense::leg(NBodyState & state, double t, double H, double ORBIT_ERROR, double HLIMIT, double DENSE_ERROR,
+                     vector<double> & out) {
+  double n0[width],n1[width],n2[width],mid[1+6*N];
+  double dir = (t < state.getTime() ? -1 : 1), h = 2*H, step, err;
+
+  state.getSnapshot(n0);
+  state.getAccelerations(n0+1+6*N);
+  out.insert(out.end(),n0,n0+width);
+
+  while ((t-state.getTime())*dir > 0) {
+    step = (fabs(t-state.getTime()) < h ? fabs(t-state.getTime()) : h);
+
+    // Integrate to the midpoint and the end of the step, then check how well
+    // the end nodes alone reproduce the midpoint
+    state(n0[0]+dir*step/2,H,ORBIT_ERROR,HLIMIT);
+    state.getSnapshot(n1);
+    state.getAccelerations(n1+1+6*N);
+
+    state(n0[0]+dir*step,H,ORBIT_ERROR,HLIMIT);
+    state.getSnapshot(n2);
+    state.getAccelerations(n2+1+6*N);
+
+    interpolate(n0,n2,n1[0],mid);
+
+    err = 0;
+    for (int i = 1; i < 1+3*N; i++)
+      if (fabs(mid[i]-n1[i]) > err) err = fabs(mid[i]-n1[i]);
+
+    if (err > DENSE_ERROR && step/2 > HLIMIT) {
+      // Too coarse, retry from the last node with half the spacing
+      state.setSnapshot(n0);
+      h = step/2;
+      continue;
+    }
+
+    // Stored nodes are half as far apart as the pair that was checked,
+    // so the interpolant is well inside the tolerance (error ~ h^6)
+    out.insert(out.end(),n1,n1+width);
+    out.insert(out.end(),n2,n2+width);
+    for (int i = 0; i < width; i++) n0[i] = n2[i];
+
+    if (err < DENSE_ERROR/64) h = 2*step;
+  }
+}
+
+void NBodyDense::interpolate(double * n0, double * n1, double t, double * snapshot) {
+  double h = n1[0]-n0[0];
+  double s = (h != 0 ? (t-n0[0])/h : 0), s2 = s*s, s3 = s2*s, s4 = s3*s, s5 = s4*s;
+
+  // Quintic Hermite basis for positions (end values, first and second derivatives) ...
+  double h0 = 1-10*s3+15*s4-6*s5, h1 = s-6*s3+8*s4-3*s5, h2 = 0.5*(s2-3*s3+3*s4-s5);
+  double h3 = 0.5*(s3-2*s4+s5), h4 = -4*s3+7*s4-3*s5, h5 = 10*s3-15*s4+6*s5;
+
+  // ... and its derivative for velocities
+  double d0 = -30*s2+60*s3-30*s4, d1 = 1-18*s2+32*s3-15*s4, d2 = 0.5*(2*s-9*s2+12*s3-5*s4);
+  double d3 = 0.5*(3*s2-8*s3+5*s4), d4 = -12*s2+28*s3-15*s4, d5 = 30*s2-60*s3+30*s4;
+
+  double *r0 = n0+1, *v0 = n0+1+3*N, *a0 = n0+1+6*N;
+  double *r1 = n1+1, *v1 = n1+1+3*N, *a1 = n1+1+6*N;
+
+  snapshot[0] = t;
+  for (int i = 0; i < 3*N; i++) {
+    snapshot[1+i] = h0*r0[i]+h1*h*v0[i]+h2*h*h*a0[i]+h3*h*h*a1[i]+h4*h*v1[i]+h5*r1[i];
+    snapshot[1+3*N+i] = (h != 0 ? (d0*r0[i]+d5*r1[i])/h : 0)+d1*v0[i]+d2*h*a0[i]+d3*h*a1[i]+d4*v1[i];
+  }
+}
+
+void NBodyDense::operator() (double t, NBodyState & state) {
+  int lo = 0, hi = size()-1, m;
+  double snapshot[1+6*N];
+
+  // Bracketing pair of nodes
+  while (hi-lo > 1) {
+    m = (lo+hi)/2;
+    if (node(m)[0] <= t) lo = m;
+    else hi = m;
+  }
+
+  interpolate(node(lo),node(hi),t,snapshot);
+  state.setSnapshot(snapshot);
+}
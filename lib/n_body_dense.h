@@ -0,0 +1,44 @@
+#ifndef _N_BODY_DENSE_
+#define _N_BODY_DENSE_
+
+#include <vector>
+#include "n_body_state.h"
+
+/*
+  n_body_dense.h
+
+  Dense output for NBodyState.  The state is integrated once across a time span with the
+  integrator's natural step, storing Jacobian positions, velocities and accelerations at each
+  node.  Positions at any time in the span are then evaluated with a quintic Hermite interpolant
+  between the bracketing nodes (velocities from its derivative), so the cost of the integration
+  depends on the orbits and not on the number of requested times.
+
+*/
+
+class NBodyDense{
+ private:
+  int N;
+  int width; // values per node, 1+6N (snapshot) + 3N (accelerations)
+  std::vector<double> nodes; // ascending in time
+
+  double * node(int i);
+  void leg(NBodyState & state, double t, double H, double ORBIT_ERROR, double HLIMIT, double DENSE_ERROR,
+           std::vector<double> & out);
+  void interpolate(double * n0, double * n1, double t, double * snapshot);
+
+ public:
+  // Integrates a copy of state from its current time back to tmin and forward to tmax.  H, ORBIT_ERROR
+  // and HLIMIT are passed to the integrator as in NBodyState::operator().  DENSE_ERROR is the largest
+  // interpolation error accepted in the Jacobian positions; node spacing starts at 2H and is halved
+  // (or doubled) while the error at the midpoint of a node pair is above (or far below) it.
+  NBodyDense(NBodyState & state, double tmin, double tmax, double H, double ORBIT_ERROR, double HLIMIT,
+             double DENSE_ERROR);
+
+  // Moves state to time t, which must lie in [tmin, tmax].
+  void operator() (double t, NBodyState & state);
+
+  // Number of stored nodes.
+  int size();
+};
+
+#endif
@@ -16,30 +16,31 @@ using namespace std;
 
 double machine_epsilon = 1e-18;
 
-NBodyState::NBodyState(double * m, double posj[][3], double velj[][3], int NN,double t0) {
+void NBodyState::allocate(int NN) {
   N = NN;
-  mass = new double[N];
-  eta = new double[N];
 
-  rj = new double*[N];
-  vj = new double*[N];
-  aj = new double*[N];
-  
-  rb = new double*[N];
-  vb = new double*[N];
+  // One block for all the values and one for the row pointers, so the
+  // coordinates of a state are contiguous and a state costs two allocations
+  store = new double[2*N+18*N];
+  rows = new double*[6*N];
 
-  rb_lt = new double*[N];
+  mass = store;
+  eta = store+N;
 
-  for (int i = 0; i < N; i++) {
-    rj[i] = new double[3];
-    vj[i] = new double[3];
-    aj[i] = new double[3];
+  rj = rows;
+  vj = rows+N;
+  aj = rows+2*N;
+  
+  rb = rows+3*N;
+  vb = rows+4*N;
 
-    rb[i] = new double[3];
-    vb[i] = new double[3];
+  rb_lt = rows+5*N;
 
-    rb_lt[i] = new double[3];
-  }
+  for (int i = 0; i < 6*N; i++) rows[i] = store+2*N+3*i;
+}
+
+NBodyState::NBodyState(double * m, double posj[][3], double velj[][3], int NN,double t0) {
+  allocate(NN);
 
   COPYN(m,mass);
   COPYN3(posj,rj);
@@ -58,30 +59,40 @@ NBodyState::NBodyState(double * m, double posj[][3], double velj[][3], int NN,do
 
 
 NBodyState::NBodyState(double * ms, double * a, double * e, double * in, double * o,double * ln, double * m, int NN, double t0) {
-  N = NN;
-  mass = new double[N];
-  eta = new double[N];
+  allocate(NN);
+  reset(ms,a,e,in,o,ln,m,t0);
+}
 
-  rj = new double*[N];
-  vj = new double*[N];
-  aj = new double*[N];
-  
-  rb = new double*[N];
-  vb = new double*[N];
+NBodyState::NBodyState(double * ms, double * snapshot, int NN) {
+  allocate(NN);
+
+  COPYN(ms,mass);
 
-  rb_lt = new double*[N];
+  calcEta();
 
+  time = snapshot[0];
   for (int i = 0; i < N; i++) {
-    rj[i] = new double[3];
-    vj[i] = new double[3];
-    aj[i] = new double[3];
+    for (int k = 0; k < 3; k++) {
+      rj[i][k] = snapshot[1+3*i+k];
+      vj[i][k] = snapshot[1+3*N+3*i+k];
+    }
+  }
+
+  evolve(rj,vj,aj,mass,eta,N,time,time,1,status,0,0);
+  bary_coords();
+  bary_coords_lt();
+}
 
-    rb[i] = new double[3];
-    vb[i] = new double[3];
+NBodyState::NBodyState(int NN) {
+  allocate(NN);
+}
 
-    rb_lt[i] = new double[3];
-  }
+NBodyState::~NBodyState() {
+  delete[] store;
+  delete[] rows;
+}
 
+void NBodyState::reset(double * ms, double * a, double * e, double * in, double * o, double * ln, double * m, double t0) {
   COPYN(ms,mass);
 
   calcEta();
@@ -94,27 +105,6 @@ NBodyState::NBodyState(double * ms, double * a, double * e, double * in, double
   time = t0;
 }
 
-NBodyState::~NBodyState() {
-  delete[] mass;
-  delete[] eta;
-  
-  for (int i = 0; i < N; i++) {
-    delete[] rj[i];
-    delete[] vj[i];
-    delete[] aj[i];
-    delete[] rb[i];
-    delete[] vb[i];
-    delete[] rb_lt[i];
-  }
-
-  delete[] rj;
-  delete[] vj;
-  delete[] aj;
-  delete[] rb;
-  delete[] vb;
-  delete[] rb_lt;
-}
-
 void NBodyState::calcEta() {
   eta[0] = mass[0];
   for (int i = 1; i < N; i++) eta[i] = eta[i-1]+mass[i];
@@ -237,6 +227,36 @@ double NBodyState::getMass(int obj) { return mass[obj]; }
 double NBodyState::getTime() { return time; }
 int NBodyState::getN() { return N;}
 
+void NBodyState::getSnapshot(double * snapshot) {
+  snapshot[0] = time;
+  for (int i = 0; i < N; i++) {
+    for (int k = 0; k < 3; k++) {
+      snapshot[1+3*i+k] = rj[i][k];
+      snapshot[1+3*N+3*i+k] = vj[i][k];
+    }
+  }
+}
+
+void NBodyState::setSnapshot(double * snapshot) {
+  time = snapshot[0];
+  for (int i = 0; i < N; i++) {
+    for (int k = 0; k < 3; k++) {
+      rj[i][k] = snapshot[1+3*i+k];
+      vj[i][k] = snapshot[1+3*N+3*i+k];
+    }
+  }
+
+  bary_coords();
+  bary_coords_lt();
+}
+
+void NBodyState::getAccelerations(double * acc) {
+  accelerations(rj,vj,aj,mass,eta,N);
+  for (int i = 0; i < N; i++) {
+    for (int k = 0; k < 3; k++) acc[3*i+k] = aj[i][k];
+  }
+}
+
 double ** NBodyState::getBaryLT() { return rb_lt; } //Careful!!!
 
 double NBodyState::X_B(int obj) { return rb[obj][0];} 
@@ -12,6 +12,8 @@
 
 class NBodyState{
  private:
+  double * store; // contiguous storage for all of the below
+  double ** rows; // row pointers into store
   double * mass;
   double * eta;
   double ** rj; //check on this (jacobian)
@@ -25,6 +27,7 @@ class NBodyState{
   int N;
   
   void calcEta();
+  void allocate(int NN);
   
   void bary_coords(); 
   double bary_coords_lt(); 
@@ -35,6 +38,13 @@ class NBodyState{
   NBodyState(double * m, double posj[][3], double velj[][3], int NN, double t0);
   // Constructor 2: initialize NBodyState with osculating elements for Jacobian coordinates.
   NBodyState(double * ms, double * a, double * e, double * in, double * o,double * ln, double * m, int NN, double t0);
+  // Constructor 3: restore NBodyState from a snapshot written by getSnapshot.
+  NBodyState(double * ms, double * snapshot, int NN);
+  // Constructor 4: allocate an NBodyState for NN bodies, to be set with reset or setSnapshot.
+  NBodyState(int NN);
+
+  // Re-initializes the state in place with new masses and osculating elements, as constructor 2.
+  void reset(double * ms, double * a, double * e, double * in, double * o, double * ln, double * m, double t0);
  
   // Evolution overloaded operator.  t is time to evolve to, H is step size in BS integrator, ORBIT_ERROR is
   // orbit error tolerance and HLIMIT is minimum step size.
@@ -58,6 +68,15 @@ class NBodyState{
   // Gets the number of bodies in the state.
   int getN();
 
+  // Writes time, Jacobian positions and Jacobian velocities (1+6N values) to snapshot.
+  void getSnapshot(double * snapshot);
+
+  // Moves the state to the time, Jacobian positions and velocities in snapshot (as written by getSnapshot).
+  void setSnapshot(double * snapshot);
+
+  // Writes the NX3 accelerations of the Jacobian coordinates to acc.
+  void getAccelerations(double * acc);
+
   // Returns NX3 matrix of positions for N objects corrected for the finite speed of light.
   double ** getBaryLT();
 
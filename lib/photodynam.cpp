@@ -1,5 +1,6 @@
 #include "n_body_state.h"
 #include "n_body_lc.h"
+#include "n_body_dense.h"
 //#include "omp.h"
 #include <iostream>
 #include <iomanip>
@@ -7,6 +8,9 @@
 #include <sstream>
 #include <string>
 #include <vector>
+#include <algorithm>
+#include <thread>
+#include <atomic>
 #include <math.h>
 #include <stdlib.h>
 #include <stdio.h>
@@ -15,40 +19,238 @@ using namespace std;
 
 extern "C"
 {
-  void start(double *time, int time_size,
+  void start(double *time, int time_size, double *texp, int nsub,
+            int N, double t0, double maxh, double orbit_error, double dense_error, double window_margin,
+            double *masses, double *radii, double *fluxes, double *u1, double *u2, double *a, double *e,
+            double *inc, double *om, double *ln, double *ma,
+            double *mod_flux, double *mod_rv, int rv_body);
+
+  void start_batch(double *time, int time_size, double *texp, int nsub,
+            int N, double t0, double maxh, double orbit_error, double dense_error, double window_margin, int nsets,
+            double *masses, double *radii, double *fluxes, double *u1, double *u2, double *a, double *e,
+            double *inc, double *om, double *ln, double *ma,
+            double *mod_flux, double *mod_rv, int rv_body, int nthreads);
+
+  void checkpoint(double *time, int time_size,
             int N, double t0, double maxh, double orbit_error,
+            double *masses, double *a, double *e, double *inc, double *om, double *ln, double *ma,
+            double *snapshots);
+
+  void start_from(double *snapshot, double *time, int time_size, double *texp, int nsub,
+            int N, double maxh, double orbit_error, double dense_error, double window_margin,
+            double *masses, double *radii, double *fluxes, double *u1, double *u2,
+            double *mod_flux, double *mod_rv, int rv_body);
+
+  int eclipses(double tstart, double tend, double dt,
+            int N, double t0, double maxh, double orbit_error, double dense_error,
             double *masses, double *radii, double *fluxes, double *u1, double *u2, double *a, double *e,
             double *inc, double *om, double *ln, double *ma,
+            int max_events, int *front, int *back, double *tmid, double *duration, double *depth);
+
+  void * model_create(double *time, int time_size, double *texp, int nsub,
+            int N, double t0, double maxh, double orbit_error, double dense_error, double window_margin,
             double *mod_flux, double *mod_rv, int rv_body);
+
+  void model_settings(void *model, double t0, double maxh, double orbit_error, double dense_error,
+            double window_margin);
+
+  void model_evaluate(void *model, double *theta);
+
+  void model_observe(void *model,
+            int nflux, int *flux_index, double *flux_y, double *flux_e,
+            int nrv, int *rv_index, int *rv_instrument, double *rv_y, double *rv_e);
+
+  void model_lnlike(void *model, double *theta, double ferr_frac, double *rv_offsets, double *rv_jitters,
+            double *terms);
+
+  void model_destroy(void *model);
 }
 
-void start(double *time, int time_size,
-            int N, double t0, double maxh, double orbit_error,
+// Time of sub-exposure k of the m spread evenly over an exposure of length
+// texp centred on t
+static double subtime(double t, double texp, int m, int k)
+{
+    return t + texp * ((k + 0.5) / m - 0.5);
+}
+
+// Whether any pair of bodies is within (1+margin) times the sum of their
+// radii on the sky, i.e. close enough to be in or near an eclipse
+static bool near_conjunction(double **pos, double *radii, int N, double margin)
+{
+    double dx, dy, rij;
+
+    for (int j = 0; j < N; j++)
+    {
+        for (int i = 0; i < j; i++)
+        {
+            dx = pos[i][0] - pos[j][0];
+            dy = pos[i][1] - pos[j][1];
+            rij = (radii[i] + radii[j]) * (1 + margin);
+
+            if (dx * dx + dy * dy < rij * rij) return true;
+        }
+    }
+
+    return false;
+}
+
+// Steps state through count of the requested times starting at index first,
+// moving forward (dir = 1) or backward (dir = -1) through the array, and
+// records flux and rv at each. Times with a non-zero exposure time texp are
+// averaged over nsub sub-exposures. With window_margin > 0 the occultations
+// are only computed near a conjunction (see near_conjunction); the integration
+// is the same either way, so this only saves their cost.
+static void evaluate(NBodyState &state, double *time, double *texp, int nsub,
+            int first, int count, int dir,
+            int N, double maxh, double orbit_error, double window_margin,
+            double *radii, double *fluxes, double *u1, double *u2,
+            double *mod_flux, double *mod_rv, int rv_body)
+{
+    for (int n = 0, i = first; n < count; n++, i += dir)
+    {
+        int m = (texp[i] > 0 ? nsub : 1);
+
+        mod_flux[i] = 0;
+        mod_rv[i] = 0;
+
+        for (int k = 0; k < m; k++)
+        {
+            // Evaluate the flux at time t0 using the getBaryLT() member method
+            // of NBodyState which returns NX3 array of barycentric, light-time
+            // corrected coordinates
+            state(subtime(time[i], texp[i], m, dir > 0 ? k : m - 1 - k), maxh, orbit_error, 1.0e-10);
+
+            // Now get the flux at the new time; far from any conjunction
+            // there is no occultation
+            if (window_margin > 0 && !near_conjunction(state.getBaryLT(), radii, N, window_margin))
+                mod_flux[i] += 1.0;
+            else
+                mod_flux[i] += occultn(state.getBaryLT(),radii,u1,u2,fluxes,N);
+
+            mod_rv[i] += state.V_Z_LT(rv_body);
+        }
+
+        mod_flux[i] /= m;
+        mod_rv[i] /= m;
+    }
+}
+
+// Integrates state once across the span of the requested times, with the
+// node spacing of the dense output set by dense_error, and interpolates the
+// state at each time (or sub-exposure, as in evaluate) from it to record
+// flux and rv.
+//
+// With window_margin > 0 the occultations are only computed for times near
+// a conjunction (see near_conjunction), found from the same interpolant;
+// everywhere else the flux is exactly 1 and there is nothing to supersample.
+static void evaluate_dense(NBodyState &state, double *time, double *texp, int nsub, int time_size,
+            int N, double maxh, double orbit_error, double dense_error, double window_margin,
+            double *radii, double *fluxes, double *u1, double *u2,
+            double *mod_flux, double *mod_rv, int rv_body)
+{
+    double tmin = state.getTime(), tmax = state.getTime();
+
+    for (int i = 0; i < time_size; i++)
+    {
+        if (time[i] - texp[i] / 2 < tmin) tmin = time[i] - texp[i] / 2;
+        if (time[i] + texp[i] / 2 > tmax) tmax = time[i] + texp[i] / 2;
+    }
+
+    bool windows = window_margin > 0;
+    double t;
+
+    NBodyDense dense(state, tmin, tmax, maxh, orbit_error, 1.0e-10, dense_error);
+
+    for (int i = 0; i < time_size; i++)
+    {
+        int m = (texp[i] > 0 ? nsub : 1);
+        bool near = !windows;
+
+        mod_flux[i] = 0;
+        mod_rv[i] = 0;
+
+        // Out of eclipse over the whole exposure, the flux is exactly 1 and
+        // there is nothing to supersample
+        for (int k = 0; k < m && !near; k++)
+        {
+            dense(subtime(time[i], texp[i], m, k), state);
+            near = near_conjunction(state.getBaryLT(), radii, N, window_margin);
+            mod_rv[i] += state.V_Z_LT(rv_body);
+        }
+
+        if (!near)
+        {
+            mod_flux[i] = 1.0;
+            mod_rv[i] /= m;
+            continue;
+        }
+
+        mod_rv[i] = 0;
+
+        for (int k = 0; k < m; k++)
+        {
+            t = subtime(time[i], texp[i], m, k);
+            dense(t, state);
+
+            mod_flux[i] += occultn(state.getBaryLT(),radii,u1,u2,fluxes,N);
+            mod_rv[i] += state.V_Z_LT(rv_body);
+        }
+
+        mod_flux[i] /= m;
+        mod_rv[i] /= m;
+    }
+}
+
+// Index of the first time at or after t0. For times sorted in ascending
+// order, everything before it lies behind the epoch and is integrated
+// backward from t0, everything from it on forward, so that each leg of the
+// orbit is only integrated once.
+static int epoch_index(double *time, int time_size, double t0)
+{
+    return lower_bound(time, time + time_size, t0) - time;
+}
+
+void start(double *time, int time_size, double *texp, int nsub,
+            int N, double t0, double maxh, double orbit_error, double dense_error, double window_margin,
             double *masses, double *radii, double *fluxes, double *u1, double *u2, double *a, double *e,
             double *inc, double *om, double *ln, double *ma,
             double *mod_flux, double *mod_rv, int rv_body)
 {
+    // With dense output the whole span is integrated once and interpolated
+    if (dense_error > 0)
+    {
+        NBodyState state(masses, a, e, inc, om, ln, ma, N, t0);
 
-    // Instantiate state; time t0 is epoch of above coordinates
-    NBodyState state(masses, a, e, inc, om, ln, ma, N, t0);
+        evaluate_dense(state, time, texp, nsub, time_size, N, maxh, orbit_error, dense_error, window_margin,
+                       radii, fluxes, u1, u2, mod_flux, mod_rv, rv_body);
+        return;
+    }
+
+    int split = epoch_index(time, time_size, t0);
 
     // Integrate forward in time with stepsize (maxh), error tolerance (orbit_error)
-    // and minimum step size of 1e-20
+    // and minimum step size of 1e-20. The legs before and after the epoch
+    // are independent, so the one behind the epoch runs on its own thread.
+    thread backward;
 
-    // Uncomment the line below if you want mpi multithreading
-    // #pragma omp parallel for
-    for (int i = 0; i < time_size; i++)
+    if (split > 0)
     {
-        // Evaluate the flux at time t0 using the getBaryLT() member method
-        // of NBodyState which returns NX3 array of barycentric, light-time
-        // corrected coordinates
-        state(time[i], maxh, orbit_error, 1.0e-10);
+        backward = thread([&]() {
+            NBodyState state(masses, a, e, inc, om, ln, ma, N, t0);
 
-        // Now get the flux at the new time
-        mod_flux[i] = occultn(state.getBaryLT(),radii,u1,u2,fluxes,N);
-        mod_rv[i] = state.V_Z_LT(rv_body);
+            evaluate(state, time, texp, nsub, split - 1, split, -1, N, maxh, orbit_error, window_margin,
+                     radii, fluxes, u1, u2, mod_flux, mod_rv, rv_body);
+        });
     }
 
+    // Instantiate state; time t0 is epoch of above coordinates
+    NBodyState state(masses, a, e, inc, om, ln, ma, N, t0);
+
+    evaluate(state, time, texp, nsub, split, time_size - split, 1, N, maxh, orbit_error, window_margin,
+             radii, fluxes, u1, u2, mod_flux, mod_rv, rv_body);
+
+    if (backward.joinable()) backward.join();
+
     // for (int i = 0; i < rv_time_size; i++)
     // {
     //   state(rv_time[i], maxh, orbit_error, 1.0e-20);
@@ -56,3 +258,423 @@ void start(double *time, int time_size,
     //   mod_rv[i] = state.V_Z_LT(2);      
     // }
 }
+
+void start_batch(double *time, int time_size, double *texp, int nsub,
+            int N, double t0, double maxh, double orbit_error, double dense_error, double window_margin, int nsets,
+            double *masses, double *radii, double *fluxes, double *u1, double *u2, double *a, double *e,
+            double *inc, double *om, double *ln, double *ma,
+            double *mod_flux, double *mod_rv, int rv_body, int nthreads)
+{
+    // Parameter arrays are (nsets x N) for the body properties and
+    // (nsets x N-1) for the orbital elements, row-major; the outputs are
+    // (nsets x time_size). Each row is an independent model, so the sets
+    // are handed out to nthreads threads as they become free.
+    int M = N - 1;
+    atomic<int> next(0);
+
+    auto worker = [&]() {
+        for (int k = next++; k < nsets; k = next++)
+        {
+            start(time, time_size, texp, nsub, N, t0, maxh, orbit_error, dense_error, window_margin,
+                  masses + k * N, radii + k * N, fluxes + k * N, u1 + k * N, u2 + k * N,
+                  a + k * M, e + k * M, inc + k * M, om + k * M, ln + k * M, ma + k * M,
+                  mod_flux + (long) k * time_size, mod_rv + (long) k * time_size, rv_body);
+        }
+    };
+
+    vector<thread> threads;
+
+    for (int i = 1; i < nthreads; i++) threads.push_back(thread(worker));
+
+    worker();
+
+    for (size_t i = 0; i < threads.size(); i++) threads[i].join();
+}
+
+void checkpoint(double *time, int time_size,
+            int N, double t0, double maxh, double orbit_error,
+            double *masses, double *a, double *e, double *inc, double *om, double *ln, double *ma,
+            double *snapshots)
+{
+    // Integrate through the given (chunk start) times and save a snapshot
+    // at each, (time_size x 1+6N), so that every chunk can be started from
+    // its own first time instead of from the epoch. As in start, times
+    // before the epoch are reached by integrating backward from it.
+    int split = epoch_index(time, time_size, t0);
+
+    NBodyState forward(masses, a, e, inc, om, ln, ma, N, t0);
+
+    for (int i = split; i < time_size; i++)
+    {
+        forward(time[i], maxh, orbit_error, 1.0e-10);
+        forward.getSnapshot(snapshots + i * (1 + 6 * N));
+    }
+
+    NBodyState backward(masses, a, e, inc, om, ln, ma, N, t0);
+
+    for (int i = split - 1; i >= 0; i--)
+    {
+        backward(time[i], maxh, orbit_error, 1.0e-10);
+        backward.getSnapshot(snapshots + i * (1 + 6 * N));
+    }
+}
+
+void start_from(double *snapshot, double *time, int time_size, double *texp, int nsub,
+            int N, double maxh, double orbit_error, double dense_error, double window_margin,
+            double *masses, double *radii, double *fluxes, double *u1, double *u2,
+            double *mod_flux, double *mod_rv, int rv_body)
+{
+    // Same as start, but resuming from a snapshot written by checkpoint
+    NBodyState state(masses, snapshot, N);
+
+    if (dense_error > 0)
+    {
+        evaluate_dense(state, time, texp, nsub, time_size, N, maxh, orbit_error, dense_error, window_margin,
+                       radii, fluxes, u1, u2, mod_flux, mod_rv, rv_body);
+        return;
+    }
+
+    evaluate(state, time, texp, nsub, 0, time_size, 1, N, maxh, orbit_error, window_margin,
+             radii, fluxes, u1, u2, mod_flux, mod_rv, rv_body);
+}
+
+// Contacts are looked for up to this far (in days) outside the searched
+// span, so that eclipses at its edges still get their full duration
+#define CONTACT_PAD 1.0
+
+// Sky-projected separation of bodies i and j at time t, and half its
+// derivative with respect to time (negative while they approach)
+static double separation(NBodyDense &dense, NBodyState &state, double t, int i, int j, double *approach)
+{
+    dense(t, state);
+
+    double dx = state.X_LT(i) - state.X_LT(j), dy = state.Y_LT(i) - state.Y_LT(j);
+
+    if (approach)
+        *approach = dx * (state.V_X_LT(i) - state.V_X_LT(j)) + dy * (state.V_Y_LT(i) - state.V_Y_LT(j));
+
+    return sqrt(dx * dx + dy * dy);
+}
+
+// Time in [lo, hi] at which the separation of i and j crosses rij, for a
+// separation above rij at lo and below it at hi (or the reverse)
+static double contact(NBodyDense &dense, NBodyState &state, double lo, double hi, int i, int j, double rij)
+{
+    bool outside = separation(dense, state, lo, i, j, NULL) > rij;
+
+    while (fabs(hi - lo) > 1.0e-9)
+    {
+        double mid = (lo + hi) / 2;
+
+        if ((separation(dense, state, mid, i, j, NULL) > rij) == outside) lo = mid;
+        else hi = mid;
+    }
+
+    return (lo + hi) / 2;
+}
+
+int eclipses(double tstart, double tend, double dt,
+            int N, double t0, double maxh, double orbit_error, double dense_error,
+            double *masses, double *radii, double *fluxes, double *u1, double *u2, double *a, double *e,
+            double *inc, double *om, double *ln, double *ma,
+            int max_events, int *front, int *back, double *tmid, double *duration, double *depth)
+{
+    // Integrates once across [tstart, tend] (and the epoch) and scans the
+    // dense output with step dt for the pairs of bodies that pass over each
+    // other. Mid-eclipse is the minimum of their sky-projected separation,
+    // found as the root of its derivative; the first and last contacts are
+    // where the separation equals the sum of the radii. The depth is the loss
+    // of total flux at mid-eclipse. Returns the number of eclipses recorded
+    // (at most max_events), in the order they are found.
+    double tmin = min(tstart, t0) - CONTACT_PAD, tmax = max(tend, t0) + CONTACT_PAD;
+
+    NBodyState state(masses, a, e, inc, om, ln, ma, N, t0);
+    NBodyDense dense(state, tmin, tmax, maxh, orbit_error, 1.0e-10,
+                     dense_error > 0 ? dense_error : 1.0e-10);
+
+    vector<double> before(N * N);
+    double t = tstart, g, lo, hi, mid, rij, t1, t4;
+    int count = 0;
+
+    for (int j = 0; j < N; j++)
+        for (int i = 0; i < j; i++)
+            separation(dense, state, t, i, j, &before[i * N + j]);
+
+    while (t < tend && count < max_events)
+    {
+        double next = min(t + dt, tend);
+
+        for (int j = 0; j < N && count < max_events; j++)
+        {
+            for (int i = 0; i < j && count < max_events; i++)
+            {
+                separation(dense, state, next, i, j, &g);
+
+                bool minimum = before[i * N + j] < 0 && g >= 0;
+                before[i * N + j] = g;
+
+                if (!minimum) continue;
+
+                // Closest approach by bisection on the derivative
+                lo = t;
+                hi = next;
+
+                while (hi - lo > 1.0e-9)
+                {
+                    mid = (lo + hi) / 2;
+                    separation(dense, state, mid, i, j, &g);
+
+                    if (g < 0) lo = mid;
+                    else hi = mid;
+                }
+
+                mid = (lo + hi) / 2;
+                rij = radii[i] + radii[j];
+
+                if (separation(dense, state, mid, i, j, NULL) >= rij) continue;
+
+                // The body nearer the observer (at -z) is in front
+                bool ifront = state.Z_LT(i) < state.Z_LT(j);
+
+                front[count] = ifront ? i : j;
+                back[count] = ifront ? j : i;
+                tmid[count] = mid;
+                depth[count] = 1 - occultn(state.getBaryLT(), radii, u1, u2, fluxes, N);
+
+                // Step outward until the disks are apart, then bisect for the
+                // contacts
+                for (t1 = mid - dt; t1 > tmin && separation(dense, state, t1, i, j, NULL) < rij; t1 -= dt);
+                for (t4 = mid + dt; t4 < tmax && separation(dense, state, t4, i, j, NULL) < rij; t4 += dt);
+
+                t1 = contact(dense, state, max(t1, tmin), mid, i, j, rij);
+                t4 = contact(dense, state, mid, min(t4, tmax), i, j, rij);
+
+                duration[count] = t4 - t1;
+                count++;
+            }
+        }
+
+        t = next;
+    }
+
+    return count;
+}
+
+// A model evaluated repeatedly on the same time grid: the grid, the output
+// buffers (both owned by the caller) and the fixed settings are given once,
+// and the integrator states are kept and re-initialized in place on every
+// evaluation.
+//
+// Observations registered with model_observe are kept grouped by the grid
+// point they belong to (flux_start[i] to flux_start[i + 1] for grid point i,
+// likewise for rv), with their variances, so that the likelihood can be
+// summed over each leg of the integration as soon as it is done.
+struct Model
+{
+    double *time, *texp, *mod_flux, *mod_rv;
+    int time_size, nsub, N, rv_body, split;
+    double t0, maxh, orbit_error, dense_error, window_margin;
+    NBodyState forward, backward;
+
+    vector<int> flux_start, rv_start, rv_instrument;
+    vector<double> flux_y, flux_var, rv_y, rv_var;
+
+    Model(int N) : forward(N), backward(N) {}
+};
+
+// Noise parameters and the running sums of one likelihood evaluation
+struct Terms
+{
+    double ferr_frac, *rv_offsets, *rv_jitters;
+    double flux, rv;
+};
+
+void * model_create(double *time, int time_size, double *texp, int nsub,
+            int N, double t0, double maxh, double orbit_error, double dense_error, double window_margin,
+            double *mod_flux, double *mod_rv, int rv_body)
+{
+    Model *model = new Model(N);
+
+    model->time = time;
+    model->texp = texp;
+    model->mod_flux = mod_flux;
+    model->mod_rv = mod_rv;
+    model->time_size = time_size;
+    model->nsub = nsub;
+    model->N = N;
+    model->rv_body = rv_body;
+    model->flux_start.assign(time_size + 1, 0);
+    model->rv_start.assign(time_size + 1, 0);
+
+    model_settings(model, t0, maxh, orbit_error, dense_error, window_margin);
+
+    return model;
+}
+
+void model_settings(void *handle, double t0, double maxh, double orbit_error, double dense_error,
+            double window_margin)
+{
+    // Replaces the epoch, step size and tolerances used by the following
+    // evaluations
+    Model &model = *(Model *) handle;
+
+    model.split = epoch_index(model.time, model.time_size, t0);
+    model.t0 = t0;
+    model.maxh = maxh;
+    model.orbit_error = orbit_error;
+    model.dense_error = dense_error;
+    model.window_margin = window_margin;
+}
+
+// Groups observations by grid point: start[i] to start[i + 1] are the ones of
+// grid point i in the reordered y and var
+static void group(int time_size, int n, int *index, double *y, double *e,
+            vector<int> &start, vector<double> &y_out, vector<double> &var_out,
+            int *extra, vector<int> *extra_out)
+{
+    vector<int> next(time_size + 1, 0);
+
+    for (int k = 0; k < n; k++) next[index[k] + 1]++;
+    for (int i = 0; i < time_size; i++) next[i + 1] += next[i];
+
+    start = next;
+    y_out.resize(n);
+    var_out.resize(n);
+    if (extra_out) extra_out->resize(n);
+
+    for (int k = 0; k < n; k++)
+    {
+        int j = next[index[k]]++;
+
+        y_out[j] = y[k];
+        var_out[j] = e[k] * e[k];
+        if (extra_out) (*extra_out)[j] = extra[k];
+    }
+}
+
+void model_observe(void *handle,
+            int nflux, int *flux_index, double *flux_y, double *flux_e,
+            int nrv, int *rv_index, int *rv_instrument, double *rv_y, double *rv_e)
+{
+    // Registers the observed photometry and rv data, each point given by the
+    // index of its time in the grid, its value and error, and for rv points
+    // the instrument they belong to
+    Model &model = *(Model *) handle;
+
+    group(model.time_size, nflux, flux_index, flux_y, flux_e,
+          model.flux_start, model.flux_y, model.flux_var, NULL, NULL);
+    group(model.time_size, nrv, rv_index, rv_y, rv_e,
+          model.rv_start, model.rv_y, model.rv_var, rv_instrument, &model.rv_instrument);
+}
+
+// Adds the terms of the count grid points starting at first, stepping by dir,
+// to the sums of r^2 / var + log(var) in terms. The photometric variance is
+// inflated by ferr_frac times the model flux and the rv variance by the
+// instrument jitter; the instrument offset is added to the model rv.
+static void accumulate(Model &model, int first, int count, int dir, Terms &terms)
+{
+    double r, var, m, f2 = terms.ferr_frac * terms.ferr_frac;
+
+    for (int n = 0, i = first; n < count; n++, i += dir)
+    {
+        m = model.mod_flux[i];
+
+        for (int k = model.flux_start[i]; k < model.flux_start[i + 1]; k++)
+        {
+            r = model.flux_y[k] - m;
+            var = model.flux_var[k] + f2 * m * m;
+            terms.flux += r * r / var + log(var);
+        }
+
+        for (int k = model.rv_start[i]; k < model.rv_start[i + 1]; k++)
+        {
+            int j = model.rv_instrument[k];
+
+            r = model.rv_y[k] - (model.mod_rv[i] + terms.rv_offsets[j]);
+            var = model.rv_var[k] + terms.rv_jitters[j] * terms.rv_jitters[j];
+            terms.rv += r * r / var + log(var);
+        }
+    }
+}
+
+// Evaluates the model for theta and, with terms given, sums the likelihood
+// terms over each leg right after it is integrated, on the leg's own thread
+static void run_model(Model &model, double *theta, Terms *terms)
+{
+    // theta holds masses, radii, fluxes, u1 and u2 (N each), followed by a,
+    // e, inc, om, ln and ma (N-1 each)
+    int N = model.N, M = N - 1;
+
+    double *masses = theta, *radii = theta + N, *fluxes = theta + 2 * N, *u1 = theta + 3 * N,
+           *u2 = theta + 4 * N, *a = theta + 5 * N, *e = a + M, *inc = e + M, *om = inc + M,
+           *ln = om + M, *ma = ln + M;
+
+    model.forward.reset(masses, a, e, inc, om, ln, ma, model.t0);
+
+    if (model.dense_error > 0)
+    {
+        evaluate_dense(model.forward, model.time, model.texp, model.nsub, model.time_size, N,
+                       model.maxh, model.orbit_error, model.dense_error, model.window_margin,
+                       radii, fluxes, u1, u2, model.mod_flux, model.mod_rv, model.rv_body);
+
+        if (terms) accumulate(model, 0, model.time_size, 1, *terms);
+        return;
+    }
+
+    // As in start, the leg behind the epoch runs on its own thread
+    thread backward;
+    Terms behind;
+
+    if (terms) behind = *terms;
+
+    if (model.split > 0)
+    {
+        backward = thread([&]() {
+            model.backward.reset(masses, a, e, inc, om, ln, ma, model.t0);
+
+            evaluate(model.backward, model.time, model.texp, model.nsub, model.split - 1, model.split, -1,
+                     N, model.maxh, model.orbit_error, model.window_margin, radii, fluxes, u1, u2,
+                     model.mod_flux, model.mod_rv, model.rv_body);
+
+            if (terms) accumulate(model, model.split - 1, model.split, -1, behind);
+        });
+    }
+
+    evaluate(model.forward, model.time, model.texp, model.nsub, model.split, model.time_size - model.split, 1,
+             N, model.maxh, model.orbit_error, model.window_margin, radii, fluxes, u1, u2,
+             model.mod_flux, model.mod_rv, model.rv_body);
+
+    if (terms) accumulate(model, model.split, model.time_size - model.split, 1, *terms);
+
+    if (backward.joinable()) backward.join();
+
+    if (terms)
+    {
+        terms->flux += behind.flux;
+        terms->rv += behind.rv;
+    }
+}
+
+void model_evaluate(void *handle, double *theta)
+{
+    run_model(*(Model *) handle, theta, NULL);
+}
+
+void model_lnlike(void *handle, double *theta, double ferr_frac, double *rv_offsets, double *rv_jitters,
+            double *terms)
+{
+    // Photometric and rv log-likelihood of the registered observations for
+    // theta (laid out as in model_evaluate), written to terms[0] and
+    // terms[1]; rv_offsets and rv_jitters hold one value per instrument
+    Terms sums = {ferr_frac, rv_offsets, rv_jitters, 0.0, 0.0};
+
+    run_model(*(Model *) handle, theta, &sums);
+
+    terms[0] = -0.5 * sums.flux;
+    terms[1] = -0.5 * sums.rv;
+}
+
+void model_destroy(void *model)
+{
+    delete (Model *) model;
+}
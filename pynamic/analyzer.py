@@ -2,31 +2,40 @@ __author__ = 'nmearl'
 
 import os
 import numpy as np
+from pynamic import statistics
 import pylab
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 from matplotlib.ticker import MaxNLocator
+from multiprocessing import Pool
 
 plt.rc('font', family='serif')
 plt.rc('font', serif='Times New Roman')
 
 
 class Analyzer(object):
-    def __init__(self, optimizer):
+    def __init__(self, optimizer, chain_file=None, burnin=0, thin=1,
+                 nwalkers=None, walkers=None):
         self.optimizer = optimizer
 
-        # burnin = int(0.5 * len(self.optimizer.chain))
-        self.samples = self.optimizer.chain
-
-        results = map(lambda v: (v[1], v[2] - v[1], v[1] - v[0]),
-                      zip(*np.percentile(self.samples[:, 1:], [16, 50, 84],
-                                         axis=0)))
-
-        for i in range(len(self.optimizer.params.get_all(True))):
-            param = self.optimizer.params.get_all(True)[i]
-            param.quantile_value = results[i][0]
-            param.upper_error = results[i][1]
-            param.lower_error = results[i][2]
+        # The optimizer's chain, or the one in chain_file, memory-mapped and
+        # with burnin and thinning applied (see chain.select). It is only
+        # ever read a block at a time, so its statistics take bounded memory
+        # however long it is (see statistics).
+        self.chain = self.optimizer.load_chain(chain_file, burnin, thin,
+                                               nwalkers, walkers,
+                                               dropnan=False, flat=False)
+        self.stats = statistics.moments(self.chain)
+        self.mean = self.stats.mean[1:]
+        self.covariance = self.stats.covariance[1:, 1:]
+
+        lower, median, upper = statistics.quantiles(self.chain, [16, 50, 84],
+                                                    self.stats)[:, 1:]
+
+        for i, param in enumerate(self.optimizer.params.get_all(True)):
+            param.quantile_value = median[i]
+            param.upper_error = upper[i] - median[i]
+            param.lower_error = median[i] - lower[i]
 
         params = self.optimizer.params
         # params.update(self.samples[
@@ -58,6 +67,11 @@ class Analyzer(object):
         self.ma = np.array(
             [params.get('ma_{0}'.format(i)) for i in [1, 2]])
 
+    @property
+    def samples(self):
+        # All samples in memory at once, for plots of each one
+        return np.concatenate(list(statistics.chunks(self.chain)))
+
     def report(self):
         redchisq = self.optimizer.redchisq()
         likelihood = 0.0  # np.max(self.samples[:, 0][self.samples[:, 0] !=
@@ -120,11 +134,15 @@ class Analyzer(object):
             self.chi(param_list=param_list, save=True, show=False)
 
     def chi(self, param_list=None, show=True, save=False):
+        samples = self.samples
+
         for i in range(1, len(self.optimizer.params.get_all(True))):
-            pylab.plot(self.samples[:, i], self.samples[:, 0], '+')
+            pylab.plot(samples[:, i], samples[:, 0], '+')
             pylab.show()
 
-    def plot_histogram(self, show=False, save=False):
+    def plot_histogram(self, show=False, save=False, nprocs=1):
+        # One page per kind of parameter; only the bins inside each panel's
+        # limits are drawn. Saved pages are rendered on nprocs processes.
         carter_params = [(0.2413, 0.2127, 1.347), (.2318, .2543, 2.0254),
                          (3.26e-4, 2.24e-4, 1.0), (0.0, 0.0, 0.39),
                          (0.0, 0.0, 0.22),
@@ -135,14 +153,19 @@ class Analyzer(object):
 
         titles = ["Star B", "Star C", "Star A"]
 
+        # Fixed-bin histograms of all parameters, in one pass over the chain
+        counts, edges = statistics.histogram(self.chain, 1000, self.stats.min,
+                                             self.stats.max)
+
         gparams = [self.masses, self.radii, self.fluxes, self.u1, self.u2,
                    self.a, self.e, self.inc, self.om, self.ln, self.ma]
         si = 0
+        pages = []
 
         for i in range(len(gparams)):
             gparam = gparams[i]
             cparam = carter_params[i]
-            fig, axes = plt.subplots(len(gparam))
+            panels = []
 
             if "mass" in gparam[0].name:
                 par_name = "Mass (M$_\odot$)"
@@ -173,10 +196,6 @@ class Analyzer(object):
             else:
                 par_name = ""
 
-            fig.subplots_adjust(hspace=0.33)
-            # fig.set_size_inches(8.5, 11)
-            axes[-1].set_xlabel("{0}".format(par_name))
-
             for j in range(len(gparam)):
                 param = gparam[j]
                 cp = cparam[j]
@@ -187,40 +206,27 @@ class Analyzer(object):
                 else:
                     title = titles[j + 1]
 
+                # The counts stay as they are; only the bin edges are
+                # converted
                 si += 1
-                samples = self.samples[:, si]
-
-                if "mass" in param.name:
-                    samples /= 2.959122E-4
-                elif "radius" in param.name:
-                    samples *= 215.1
-                elif ("inc" in param.name or "om" in param.name or
-                              "ln" in param.name or "ma" in param.name):
-                    samples = np.rad2deg(samples)
-                elif "gamma" in param.name:
-                    samples /= 5.775e-4
+                scale = param.get_scale()
+                bins = edges[si] * scale
 
                 qval, qupper, qlowerr = param.get_real_quantile()
+                xlim = ((qval - qlowerr) * 0.98, (qval + qupper) * 1.02)
 
-                axes[j].set_title(title)  # , x=0.85, y=0.85)
-                axes[j].set_ylabel("Count")
+                # The bins that show within the limits
+                lo = max(np.searchsorted(bins, min(xlim), side='right') - 1,
+                         0)
+                hi = np.searchsorted(bins, max(xlim), side='left') + 1
 
-                axes[j].hist(samples, 1000, color="k", alpha=0.5,
-                             histtype="step", facecolor='gray')
-                axes[j].axvline(qval, color="r", lw=2)
-                axes[j].axvline(qval + qupper, color='k', ls='-.')
-                axes[j].axvline(qval - qlowerr, color='k', ls='-.')
-                # axes[j].axvline(cp, ls='--')
-                axes[j].set_xlim((qval - qlowerr) * 0.98,
-                                 (qval + qupper) * 1.02)
+                panels.append((title, bins[lo:hi], counts[si][lo:hi - 1],
+                               (qval, qupper, qlowerr), xlim))
 
-            if save:
-                plt.savefig("dist_{0}.png".format(gparam[0].name), dpi=300,
-                            bbox_inches='tight')
-            if show:
-                plt.show()
+            path = "dist_{0}.png".format(gparam[0].name) if save else None
+            pages.append((panels, par_name, path, show))
 
-            plt.close()
+        render(_histogram_page, pages, 1 if show else nprocs)
 
     def plot_flux(self, save=False, show=True, prefix='plot_flux'):
         mod_flux, mod_rv = self.optimizer.model()
@@ -244,19 +250,17 @@ class Analyzer(object):
             filled_x)
 
         rv_x, rv_y, rv_e = self.optimizer.rv_data
+        instrument = self.optimizer.likelihood.instrument
 
-        rv_e /= 5.775e-4
+        rv_e = rv_e / 5.775e-4
         rv_y = (rv_y / 5.775e-4)  # - 0.26 - 27.278
         mod_rv = (mod_rv / 5.775e-4)  # - 0.26 - 27.278
         filled_rv = (filled_rv / 5.775e-4)  # - 0.26 - 27.278
 
         print(mod_rv)
-        # REMOVE THIS LATER
-        trv_corr = self.optimizer.params.get("gamma_t").get_real()
-        mrv_corr = self.optimizer.params.get("gamma_m").get_real()
-        mod_rv[:10] += trv_corr
-        mod_rv[10:] += mrv_corr
-        filled_rv += (trv_corr + mrv_corr) * 0.5
+        offset = self.optimizer.likelihood.rv_offset() / 5.775e-4
+        mod_rv += offset
+        filled_rv += np.mean(offset) if offset.size else 0.0
 
         print(mod_rv)
 
@@ -283,10 +287,10 @@ class Analyzer(object):
         # top_plot.plot(rv_x, mod_rv, 'bD')
         top_plot.plot(filled_x, filled_rv, 'r')
 
-        bottom_plot.errorbar(rv_x[:10], rv_y[:10] - mod_rv[:10],
-                             yerr=rv_e[:10], color='k', fmt='o')
-        bottom_plot.errorbar(rv_x[10:], rv_y[10:] - mod_rv[10:],
-                             yerr=rv_e[10:], color='k', fmt='o')
+        for k in np.unique(instrument):
+            inst = instrument == k
+            bottom_plot.errorbar(rv_x[inst], rv_y[inst] - mod_rv[inst],
+                                 yerr=rv_e[inst], color='k', fmt='o')
         bottom_plot.axhline(0.0, ls='--', color='k', alpha=0.5)
 
         if save:
@@ -331,77 +335,156 @@ class Analyzer(object):
 
         plt.show()
 
-    def plot_eclipse(self, t_start, period, show=False, save=False):
+    def plot_eclipse(self, t_start, period, show=False, save=False,
+                     nprocs=1, downsample=1):
+        # Pages of four eclipses each, starting at t_start, every period. The
+        # data are sorted once and each panel only gets the points inside its
+        # window; with downsample, only every downsample-th point is kept
+        # where the model is flat (out of eclipse). Saved pages are rendered
+        # on nprocs processes.
         mod_flux, mod_rv = self.optimizer.model()
-        time = self.optimizer.photo_data[0]
-        flux = self.optimizer.photo_data[1]
+        time, flux = self.optimizer.photo_data[0], self.optimizer.photo_data[1]
 
-        ieclipse = -1
-        for i in np.arange(t_start, time[-1], period * 4):
-            ieclipse += 1
-            gs = gridspec.GridSpec(3, 4)
-            fig = plt.figure()
-            fig.subplots_adjust(hspace=0.05, wspace=0.05)
-            # fig.tight_layout()
+        order = np.argsort(time)
+        time, flux, mod_flux = time[order], flux[order], mod_flux[order]
+        spacing = 0.5
 
-            # fig.set_size_inches(11, 8.5)
+        pages = []
 
-            top_plots, bottom_plots = [], []
+        for ieclipse, i in enumerate(np.arange(t_start, time[-1], period * 4)):
+            panels = []
 
             for j in range(4):
-                if j > 0:
-                    top_plots.append(plt.subplot(gs[0:2, j],
-                                                 sharey=top_plots[0]))
-                    plt.setp(top_plots[j].get_yticklabels(), visible=False)
-                    bottom_plots.append(plt.subplot(gs[2, j],
-                                                    sharey=bottom_plots[0]))
-                    bottom_plots[j].get_yaxis().set_visible(False)
-                else:
-                    top_plots.append(plt.subplot(gs[0:2, j]))
-                    bottom_plots.append(plt.subplot(gs[2, j]))
-
-                plt.setp(top_plots[j].get_xticklabels(), visible=False)
-                bottom_plots[j].yaxis.set_major_locator(MaxNLocator(4))
-                bottom_plots[j].xaxis.set_major_locator(MaxNLocator(4))
-                top_plots[j].xaxis.set_major_locator(MaxNLocator(4))
-                # bottom_plots[j].get_xaxis().get_major_formatter(
-                # ).set_powerlimits((0, 0))
-                # bottom_plots[j].ticklabel_format(style='sci',
-                # scilimits=(0, 0), axis='x')
-                top_plots[j].get_xaxis().get_major_formatter().set_useOffset(
-                    False)
-                bottom_plots[j].get_xaxis().get_major_formatter().set_useOffset(
-                    False)
-
-                plt.setp(bottom_plots[j].xaxis.get_majorticklabels(),
-                         rotation=15)
-
-            top_plots[0].set_ylabel("Normalized Flux")
-            # bottom_plots[0].set_xlabel('Time (BJD - 2,455,000)')
-            fig.text(0.5, 0.04, 'Time (BJD - 2,455,000)', ha='center',
-                     va='center')
-            bottom_plots[0].set_ylabel("Residuals")
-            spacing = 0.5
+                xlim = (i + period * j - spacing, i + period * j + spacing)
+                lo, hi = np.searchsorted(time, xlim)
+                keep = window(mod_flux[lo:hi], downsample)
 
-            for j in range(4):
-                top_plots[j].set_xlim(i + period * j - spacing,
-                                      i + period * j + spacing)
-                top_plots[j].set_ylim(0.968, 1.005)
-                top_plots[j].plot(time, flux, 'k.')
-                top_plots[j].plot(time[np.argsort(time)],
-                                  mod_flux[np.argsort(time)], 'r')
-                # top_plots[j].autoscale(tight=True)
-
-                bottom_plots[j].set_xlim(i + period * j - spacing,
-                                         i + period * j + spacing)
-                bottom_plots[j].plot(time, flux - mod_flux, 'k.')
-                bottom_plots[j].set_ylim(-0.004, 0.004)
-                # bottom_plots[j].autoscale(tight=True)
-
-            if save:
-                plt.savefig("resid_{0}.png".format(ieclipse), dpi=150,
-                            bbox_inches='tight')
-            if show:
-                plt.show()
-
-            plt.close()
\ No newline at end of file
+                panels.append((time[lo:hi][keep], flux[lo:hi][keep],
+                               mod_flux[lo:hi][keep], xlim))
+
+            path = "resid_{0}.png".format(ieclipse) if save else None
+            pages.append((panels, path, show))
+
+        render(_eclipse_page, pages, 1 if show else nprocs)
+
+
+def window(model, downsample=1, tol=1.0e-6):
+    # Points of a window to draw: all of them where the model changes, and
+    # every downsample-th one where it stays at its highest (out of eclipse)
+    keep = np.ones(model.size, dtype=bool)
+
+    if downsample > 1 and model.size:
+        flat = model >= model.max() - tol
+        keep[flat] = np.arange(model.size)[flat] % downsample == 0
+
+    return keep
+
+
+def _init_renderer():
+    plt.switch_backend('agg')
+
+
+def render(page, pages, nprocs=1):
+    # Renders each of pages with page, on nprocs processes using a
+    # non-interactive backend (so only for pages that are saved, not shown)
+    if nprocs > 1 and len(pages) > 1:
+        pool = Pool(nprocs, initializer=_init_renderer)
+
+        try:
+            pool.map(page, pages)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        for args in pages:
+            page(args)
+
+
+def _histogram_page(args):
+    panels, par_name, path, show = args
+    fig, axes = plt.subplots(len(panels))
+
+    fig.subplots_adjust(hspace=0.33)
+    # fig.set_size_inches(8.5, 11)
+    axes[-1].set_xlabel("{0}".format(par_name))
+
+    for j, (title, bins, counts, quantile, xlim) in enumerate(panels):
+        qval, qupper, qlowerr = quantile
+
+        axes[j].set_title(title)  # , x=0.85, y=0.85)
+        axes[j].set_ylabel("Count")
+
+        axes[j].hist(bins[:-1], bins, weights=counts, color="k", alpha=0.5,
+                     histtype="step", facecolor='gray')
+        axes[j].axvline(qval, color="r", lw=2)
+        axes[j].axvline(qval + qupper, color='k', ls='-.')
+        axes[j].axvline(qval - qlowerr, color='k', ls='-.')
+        # axes[j].axvline(cp, ls='--')
+        axes[j].set_xlim(*xlim)
+
+    if path:
+        plt.savefig(path, dpi=300, bbox_inches='tight')
+    if show:
+        plt.show()
+
+    plt.close()
+
+
+def _eclipse_page(args):
+    panels, path, show = args
+    gs = gridspec.GridSpec(3, 4)
+    fig = plt.figure()
+    fig.subplots_adjust(hspace=0.05, wspace=0.05)
+    # fig.tight_layout()
+
+    # fig.set_size_inches(11, 8.5)
+
+    top_plots, bottom_plots = [], []
+
+    for j in range(4):
+        if j > 0:
+            top_plots.append(plt.subplot(gs[0:2, j], sharey=top_plots[0]))
+            plt.setp(top_plots[j].get_yticklabels(), visible=False)
+            bottom_plots.append(plt.subplot(gs[2, j],
+                                            sharey=bottom_plots[0]))
+            bottom_plots[j].get_yaxis().set_visible(False)
+        else:
+            top_plots.append(plt.subplot(gs[0:2, j]))
+            bottom_plots.append(plt.subplot(gs[2, j]))
+
+        plt.setp(top_plots[j].get_xticklabels(), visible=False)
+        bottom_plots[j].yaxis.set_major_locator(MaxNLocator(4))
+        bottom_plots[j].xaxis.set_major_locator(MaxNLocator(4))
+        top_plots[j].xaxis.set_major_locator(MaxNLocator(4))
+        # bottom_plots[j].get_xaxis().get_major_formatter(
+        # ).set_powerlimits((0, 0))
+        # bottom_plots[j].ticklabel_format(style='sci',
+        # scilimits=(0, 0), axis='x')
+        top_plots[j].get_xaxis().get_major_formatter().set_useOffset(False)
+        bottom_plots[j].get_xaxis().get_major_formatter().set_useOffset(False)
+
+        plt.setp(bottom_plots[j].xaxis.get_majorticklabels(), rotation=15)
+
+    top_plots[0].set_ylabel("Normalized Flux")
+    # bottom_plots[0].set_xlabel('Time (BJD - 2,455,000)')
+    fig.text(0.5, 0.04, 'Time (BJD - 2,455,000)', ha='center', va='center')
+    bottom_plots[0].set_ylabel("Residuals")
+
+    for j, (time, flux, mod_flux, xlim) in enumerate(panels):
+        top_plots[j].set_xlim(*xlim)
+        top_plots[j].set_ylim(0.968, 1.005)
+        top_plots[j].plot(time, flux, 'k.')
+        top_plots[j].plot(time, mod_flux, 'r')
+        # top_plots[j].autoscale(tight=True)
+
+        bottom_plots[j].set_xlim(*xlim)
+        bottom_plots[j].plot(time, flux - mod_flux, 'k.')
+        bottom_plots[j].set_ylim(-0.004, 0.004)
+        # bottom_plots[j].autoscale(tight=True)
+
+    if path:
+        plt.savefig(path, dpi=150, bbox_inches='tight')
+    if show:
+        plt.show()
+
+    plt.close()
@@ -0,0 +1,243 @@
+__author__ = 'nmearl'
+
+import os
+import struct
+import threading
+import numpy as np
+
+# Size of the .npy header written by ChainStore: magic string, version and
+# header length (10 bytes) followed by the padded header dictionary. Keeping
+# it fixed lets the shape be rewritten in place as rows are appended.
+HEADER_SIZE = 128
+
+
+def write_header(f, nrows, ncols):
+    header = "{{'descr': '<f8', 'fortran_order': False, " \
+             "'shape': ({0}, {1}), }}".format(nrows, ncols)
+    header = header.ljust(HEADER_SIZE - 11) + '\n'
+
+    f.seek(0)
+    f.write(b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) +
+            header.encode('latin1'))
+
+
+def read_header(f):
+    # Shape of a .npy file written by ChainStore (or any C-ordered float64
+    # .npy whose data starts at HEADER_SIZE)
+    f.seek(0)
+
+    if np.lib.format.read_magic(f) != (1, 0):
+        raise ValueError("{0} isn't a version 1.0 .npy file.".format(f.name))
+
+    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+
+    if (f.tell() != HEADER_SIZE or fortran_order or
+            dtype != np.dtype('<f8') or len(shape) != 2):
+        raise ValueError("{0} can't be appended to; it isn't a 2-d float64 "
+                         ".npy file with a {1}-byte header.".format(
+                             f.name, HEADER_SIZE))
+
+    return shape
+
+
+# Append-only store of chain samples (rows of lnp followed by the parameter
+# vector). Rows are collected in a preallocated buffer and appended in blocks,
+# e.g. one whole ensemble step at a time. Without a path everything stays in
+# the buffer, which doubles in size when full. With a path the buffer is
+# written to the end of a .npy file whenever it fills up (and on flush), and
+# only the header is rewritten, so memory use stays bounded and the file can
+# be opened memory-mapped by readers at any time. The file is only created
+# once there is something to write; with append=True an existing file is
+# continued instead of replaced.
+#
+# Appending and flushing may happen on different threads. While deferred is
+# set (e.g. by a CheckpointWriter that flushes in the background), a full
+# buffer grows instead of being written, so appending never waits for the
+# disk.
+class ChainStore(object):
+    def __init__(self, ncols, path=None, capacity=4096, append=False):
+        self.ncols = ncols
+        self.path = path
+        self.buffer = np.zeros((capacity, ncols))
+        self.pending = 0
+        self.flushing = 0
+        self.written = 0
+        self.created = False
+        self.deferred = False
+        self._locks()
+
+        if path and append and os.path.exists(path):
+            with open(path, 'rb') as f:
+                nrows, ncols = read_header(f)
+
+            if ncols != self.ncols:
+                raise ValueError("{0} has {1} columns, expected {2}.".format(
+                    path, ncols, self.ncols))
+
+            self.written = nrows
+            self.created = True
+
+    def _locks(self):
+        # lock guards the buffer and the row counts, write_lock the file
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock'], state['write_lock']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._locks()
+
+    def truncate(self, nrows):
+        # Continues the existing file after its first nrows rows (e.g. the
+        # ones a resumed sampler state accounts for); later rows are dropped
+        if not self.path or (not nrows and not os.path.exists(self.path)):
+            return
+
+        with self.write_lock:
+            with open(self.path, 'r+b') as f:
+                written, ncols = read_header(f)
+
+                if ncols != self.ncols or nrows > written:
+                    raise ValueError("{0} has {1} rows of {2} columns, "
+                                     "expected {3} of {4}.".format(
+                                         self.path, written, ncols, nrows,
+                                         self.ncols))
+
+                write_header(f, nrows, self.ncols)
+                f.truncate(HEADER_SIZE + nrows * self.ncols * 8)
+
+            with self.lock:
+                self.pending = 0
+                self.written = nrows
+
+            self.created = True
+
+    def __len__(self):
+        # Rows on disk, being written and still in the buffer, counted
+        # together so a flush on another thread never hides any of them
+        with self.lock:
+            return self.written + self.flushing + self.pending
+
+    def append(self, rows):
+        rows = np.atleast_2d(rows)
+
+        if (self.path and not self.deferred and
+                self.pending + len(rows) > len(self.buffer)):
+            self.flush()
+
+        with self.lock:
+            # Still too small (no path, deferred writes, or a block larger
+            # than the buffer)
+            if self.pending + len(rows) > len(self.buffer):
+                capacity = max(2 * len(self.buffer), self.pending + len(rows))
+                buffer = np.zeros((capacity, self.ncols))
+                buffer[:self.pending] = self.buffer[:self.pending]
+                self.buffer = buffer
+
+            self.buffer[self.pending:self.pending + len(rows)] = rows
+            self.pending += len(rows)
+
+    def flush(self):
+        if not self.path:
+            return
+
+        with self.write_lock:
+            # Only hold up appends for as long as it takes to copy the rows
+            with self.lock:
+                rows = self.buffer[:self.pending].astype('<f8')
+                self.flushing = self.pending
+                self.pending = 0
+
+            if not len(rows):
+                return
+
+            mode = 'r+b' if self.created else 'w+b'
+
+            with open(self.path, mode) as f:
+                if not self.created:
+                    write_header(f, 0, self.ncols)
+                    self.created = True
+
+                # The data goes in first; rewriting the shape then commits it
+                f.seek(HEADER_SIZE + self.written * self.ncols * 8)
+                f.write(rows.tobytes())
+                f.flush()
+
+                write_header(f, self.written + len(rows), self.ncols)
+
+            with self.lock:
+                self.written += len(rows)
+                self.flushing = 0
+
+    def array(self):
+        # All rows so far. From a file this is a copy-on-write memory map, so
+        # changes made by the caller never reach the file.
+        if not self.path:
+            return self.buffer[:self.pending]
+
+        self.flush()
+
+        if not self.created:
+            return np.zeros((0, self.ncols))
+
+        return np.load(self.path, mmap_mode='c')
+
+
+def select(chain, burnin=0, thin=1, nwalkers=None, walkers=None,
+           dropnan=True, flat=True):
+    # Rows of a chain to keep. With nwalkers the rows are taken as ensemble
+    # steps of nwalkers rows each (as hammer writes them): burnin and thin
+    # count steps, walkers picks walkers within each step and an incomplete
+    # last step is left out. Without it, burnin and thin count rows. Slicing
+    # a memory map only gives a view, so only the rows that are kept are ever
+    # read. Rows whose lnp is nan are dropped if dropnan is set.
+    #
+    # Thinned or picked steps can only be put back into rows by copying them;
+    # without flat they are left as an array of (steps, walkers, columns)
+    # instead, and nan rows are left in (see statistics.chunks).
+    if nwalkers:
+        nsteps = len(chain) // nwalkers
+        chain = chain[:nsteps * nwalkers].reshape(nsteps, nwalkers, -1)
+        chain = chain[burnin::thin]
+
+        if walkers is not None:
+            chain = chain[:, walkers]
+
+        if not flat:
+            return chain
+
+        chain = chain.reshape(-1, chain.shape[-1])
+    else:
+        chain = chain[burnin::thin]
+
+    if dropnan:
+        keep = ~np.isnan(chain[:, 0])
+
+        if not keep.all():
+            chain = chain[keep]
+
+    return chain
+
+
+def load_chain(path, burnin=0, thin=1, nwalkers=None, walkers=None,
+               dropnan=True, flat=True):
+    # Rows of the chain saved in path (see select), memory-mapped read-only
+    return select(np.load(path, mmap_mode='r'), burnin, thin, nwalkers,
+                  walkers, dropnan, flat)
+
+
+def last_position(chain, nwalkers):
+    # Parameters of each walker in the last complete ensemble step, to
+    # continue sampling from
+    nsteps = len(chain) // nwalkers
+
+    if not nsteps:
+        raise ValueError("The chain has no complete step of {0} "
+                         "walkers.".format(nwalkers))
+
+    return np.array(chain[(nsteps - 1) * nwalkers:nsteps * nwalkers, 1:])
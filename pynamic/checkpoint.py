@@ -0,0 +1,120 @@
+__author__ = 'nmearl'
+
+import os
+import threading
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+from contextlib import contextmanager
+
+# os.rename doesn't replace existing files on Windows (and os.replace is
+# missing on Python 2)
+replace = getattr(os, 'replace', os.rename)
+
+
+@contextmanager
+def atomic_open(path, mode='w'):
+    # Write to a temporary file next to path and move it over path once
+    # complete, so readers (and restarts) never see a partial file
+    tmp = '{0}.tmp{1}'.format(path, os.getpid())
+
+    try:
+        with open(tmp, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+
+        replace(tmp, path)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def save_state(path, state):
+    # Sampler state (a dict of plain values and arrays), replaced atomically
+    with atomic_open(path, 'wb') as f:
+        pickle.dump(state, f, protocol=2)
+
+
+def load_state(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+class CheckpointWriter(threading.Thread):
+    # Writes checkpoints of an optimizer in the background, at most once
+    # every min_interval seconds: the latest best parameters handed to submit
+    # (older ones that were never written are dropped) and the chain samples
+    # collected since the last checkpoint. Samplers only copy the values
+    # they submit and never wait for the disk. A sampler state submitted
+    # along the way is written (to the optimizer's state_file) after the
+    # chain, so the chain file always holds every row the state accounts
+    # for. stop() writes whatever is left and ends the thread. A write that
+    # fails ends the thread too; its error is raised again from the next
+    # submit or from stop.
+    def __init__(self, optimizer, min_interval=30.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.optimizer = optimizer
+        self.min_interval = min_interval
+        self.condition = threading.Condition()
+        self.best = None
+        self.state = None
+        self.running = True
+        self.writes = 0
+        self.error = None
+
+    def check(self):
+        if self.error is not None:
+            raise self.error
+
+    def submit(self, values=None, state=None):
+        with self.condition:
+            self.check()
+
+            if values is not None:
+                self.best = values.copy()
+
+            if state is not None:
+                self.state = state
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.join()
+        self.check()
+
+    def run(self):
+        running = True
+
+        while running:
+            with self.condition:
+                if self.running:
+                    self.condition.wait(self.min_interval)
+
+                best, self.best = self.best, None
+                state, self.state = self.state, None
+                running = self.running
+
+            try:
+                self.write(best, state)
+            except Exception as e:
+                with self.condition:
+                    self.error = e
+                    self.running = False
+
+                running = False
+
+    def write(self, best, state=None):
+        if best is not None:
+            self.optimizer.params.save(values=best)
+
+        self.optimizer.chain_store.flush()
+
+        if state is not None:
+            save_state(self.optimizer.state_file, state)
+
+        self.writes += 1
@@ -0,0 +1,155 @@
+__author__ = 'nmearl'
+
+import numpy as np
+from pynamic.chain import select
+
+
+def autocorr_function(x):
+    # Normalized autocorrelation of x along its first axis, computed with an
+    # FFT padded to avoid wrapping around
+    nsteps = len(x)
+    n = 1 << int(np.ceil(np.log2(2 * nsteps)))
+    x = x - x.mean(axis=0)
+
+    f = np.fft.rfft(x, n=n, axis=0)
+    acf = np.fft.irfft(f * np.conjugate(f), n=n, axis=0)[:nsteps]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        acf = np.where(acf[0] > 0.0, acf / acf[0], 0.0)
+
+    return acf
+
+
+def autocorr_time(samples, c=5.0):
+    # Integrated autocorrelation time of each parameter of samples, an array
+    # of (steps, walkers, parameters), from the autocorrelation averaged over
+    # the walkers. The sum is cut off at the smallest window m with
+    # m >= c * tau(m) (Sokal's automatic windowing).
+    nsteps = len(samples)
+    acf = autocorr_function(np.asarray(samples)).mean(axis=1)
+    taus = 2.0 * np.cumsum(acf, axis=0) - 1.0
+    ok = np.arange(nsteps)[:, None] >= c * taus
+    tau = taus[ok.argmax(axis=0), np.arange(taus.shape[1])]
+
+    return np.where(ok.any(axis=0), tau, taus[-1])
+
+
+def gelman_rubin(samples):
+    # Potential scale reduction factor (R-hat) of each parameter of samples,
+    # (steps, walkers, parameters), treating each walker as a chain
+    n = len(samples)
+    within = samples.var(axis=0, ddof=1).mean(axis=0)
+    between = n * samples.mean(axis=0).var(axis=0, ddof=1)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.sqrt(((n - 1.0) / n * within + between / n) / within)
+
+
+# Convergence of an ensemble run, worked out every check_every steps from the
+# walker positions handed to add each step. Only the last window steps are
+# kept, in memory, so a check never touches the chain file: the
+# autocorrelation time of each parameter over the window and R-hat over its
+# second half. The run counts as converged once the window spans more than
+# ntau autocorrelation times of every parameter, the estimates changed by less
+# than tau_tol (relative) since the last check and every R-hat is below
+# rhat_max (unless that is None). A window too short for that is doubled, so
+# long autocorrelation times aren't underestimated for good. The latest values
+# are kept for display.
+class Convergence(object):
+    def __init__(self, ntau=50.0, tau_tol=0.01, rhat_max=1.01,
+                 check_every=100, c=5.0, window=5000):
+        self.ntau = ntau
+        self.tau_tol = tau_tol
+        self.rhat_max = rhat_max
+        self.check_every = check_every
+        self.c = c
+        self.window = window
+
+        self.samples = None
+        self.head = 0
+        self.held = 0
+        self.nsteps = 0
+        self.tau = None
+        self.rhat = None
+        self.converged = False
+        self.history = []
+
+    def reset(self, chain=None, nwalkers=None):
+        # Starts over, counting the steps already in chain (whole steps of
+        # nwalkers rows of lnp and parameters, as hammer writes them) and
+        # keeping the last window of them; only those rows are read
+        self.samples = None
+        self.head = self.held = self.nsteps = 0
+
+        if chain is not None and nwalkers and len(chain) >= nwalkers:
+            nsteps = len(chain) // nwalkers
+            start = max(nsteps - self.window, 0)
+            samples = select(chain[start * nwalkers:nsteps * nwalkers],
+                             nwalkers=nwalkers, dropnan=False, flat=False)
+            self.nsteps = start
+
+            for pos in samples:
+                self.add(pos[:, 1:])
+
+    def add(self, pos):
+        # Positions (walkers, parameters) of one step
+        if self.samples is None:
+            self.samples = np.zeros((self.window,) + np.shape(pos))
+
+        self.samples[self.head] = pos
+        self.head = (self.head + 1) % self.window
+        self.held = min(self.held + 1, self.window)
+        self.nsteps += 1
+
+    def window_samples(self):
+        # The steps held, oldest first
+        if self.held < self.window:
+            return self.samples[:self.held]
+
+        return np.concatenate([self.samples[self.head:],
+                               self.samples[:self.head]])
+
+    def grow(self, window):
+        samples = self.window_samples()
+        self.samples = np.zeros((window,) + samples.shape[1:])
+        self.samples[:len(samples)] = samples
+        self.head = len(samples)
+        self.window = window
+
+    def due(self, iteration):
+        return iteration % self.check_every == 0
+
+    def update(self):
+        nsteps = self.nsteps
+
+        if self.held < 4:
+            return False
+
+        samples = self.window_samples()
+        tau = autocorr_time(samples, self.c)
+        rhat = gelman_rubin(samples[len(samples) // 2:])
+
+        converged = self.tau is not None and \
+            np.all(len(samples) > self.ntau * tau) and \
+            np.all(np.abs(self.tau - tau) < self.tau_tol * tau)
+
+        if self.held == self.window and np.any(self.ntau * tau >= self.window):
+            self.grow(2 * self.window)
+
+        if self.rhat_max is not None:
+            converged = converged and np.all(rhat < self.rhat_max)
+
+        self.tau, self.rhat = tau, rhat
+        self.converged = bool(converged)
+        self.history.append((nsteps, tau.max(), np.nanmax(rhat)))
+
+        return self.converged
+
+    def summary(self):
+        if self.tau is None:
+            return 'Steps: {0} | no estimates yet'.format(self.nsteps)
+
+        return 'Steps: {0} | Max tau: {1:.1f} | Steps / tau: {2:.1f} | ' \
+               'Max R-hat: {3:.4f} | Converged: {4}'.format(
+                   self.nsteps, self.tau.max(), self.nsteps / self.tau.max(),
+                   np.nanmax(self.rhat), self.converged)
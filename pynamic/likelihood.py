@@ -0,0 +1,169 @@
+__author__ = 'nmearl'
+
+import numpy as np
+
+
+# Gaussian log-likelihood of the photometric and rv data for given model
+# values. Everything that only depends on the data (variances, their log terms,
+# the instrument of each rv point) is worked out once, so that an evaluation
+# is a single pass over one residual vector.
+#
+# Each rv instrument has its own offset and jitter parameter, named in
+# instruments as either an offset name or an (offset, jitter) pair, indexed by
+# the instrument number of each rv point; None stands for no such parameter.
+# Named parameters that aren't defined are an error. By default instrument k
+# uses 'gamma_k' and 'jitter_k' if they are defined, and a single instrument
+# also 'gamma' and 'jitter'; each of several instruments needs its offset, and
+# offsets left over are an error rather than silently unused. With rv_split
+# (and no instrument numbers) the rv points from rv_split on are a second
+# instrument, with offsets gamma_t and gamma_m unless named otherwise, as in
+# the original fit (which split at 10). The photometric errors are inflated by
+# ferr_frac times the model flux, as before.
+class Likelihood(object):
+    def __init__(self, params, photo_data, rv_data, rv_instrument=None,
+                 instruments=None, rv_split=None):
+        self.params = params
+
+        flux_y, flux_e = photo_data[1], photo_data[2]
+        rv_y, rv_e = rv_data[1], rv_data[2]
+        names = [x.name for x in params.get_all()]
+
+        self.nflux = flux_y.size
+
+        if rv_split is not None and rv_instrument is None:
+            rv_instrument = np.arange(rv_y.size) >= rv_split
+
+            if instruments is None:
+                instruments = ['gamma_t', 'gamma_m']
+
+        self.instrument = np.zeros(rv_y.size, dtype=int) \
+            if rv_instrument is None else np.asarray(rv_instrument, dtype=int)
+
+        ninst = self.instrument.max() + 1 if self.instrument.size else 0
+
+        def default(prefix, k):
+            candidates = ['{0}_{1}'.format(prefix, k)]
+
+            if ninst == 1:
+                candidates.append(prefix)
+
+            return next((x for x in candidates if x in names), None)
+
+        if instruments is None:
+            instruments = [(default('gamma', k), default('jitter', k))
+                           for k in range(ninst)]
+            offsets = [x[0] for x in instruments]
+            unused = [x for x in names
+                      if x.startswith('gamma') and x not in offsets]
+
+            if (ninst > 1 and None in offsets) or unused:
+                raise ValueError("The rv offsets ({0}) don't match the {1} rv "
+                                 "instruments; name them in the rv "
+                                 "instruments, or give rv_split for the "
+                                 "original gamma_t/gamma_m split.".format(
+                                     ', '.join(unused) or 'none', ninst))
+
+        instruments = [(x, None) if isinstance(x, str) or x is None
+                       else tuple(x) for x in instruments]
+
+        if len(instruments) < ninst:
+            raise ValueError("The rv data has {0} instruments, but only {1} "
+                             "are defined.".format(ninst, len(instruments)))
+
+        missing = [x for pair in instruments for x in pair
+                   if x is not None and x not in names]
+
+        if missing:
+            raise ValueError("The rv offset and jitter parameters {0} aren't "
+                             "defined; add them, or name the ones to use "
+                             "(None for none) in the rv instruments.".format(
+                                 ', '.join(missing)))
+
+        self.instruments = instruments
+
+        # Positions of the offsets and jitters in the parameter values; the
+        # ones that are None point at an extra zero appended to them
+        def index(name):
+            return names.index(name) if name in names else -1
+
+        self.offset_index = np.array([index(x[0]) for x in instruments],
+                                     dtype=int)
+        self.jitter_index = np.array([index(x[1]) for x in instruments],
+                                     dtype=int)
+        self.ferr_index = index('ferr_frac')
+
+        self.y = np.concatenate([flux_y, rv_y])
+        self.variance = np.concatenate([flux_e, rv_e]) ** 2
+
+        self.model = np.zeros(self.y.size)
+        self.resid = np.zeros(self.y.size)
+        self.inv_sigma2 = np.zeros(self.y.size)
+
+        # Inverse variances and their log term for the jitters they were
+        # last worked out for; only refreshed when the jitters change
+        self.jitter = None
+        self.static_inv_sigma2 = None
+        self.static_log = 0.0
+
+    def _values(self):
+        return np.append(self.params.values, 0.0)
+
+    def _cache(self, jitter):
+        self.jitter = jitter
+        self.static_inv_sigma2 = 1.0 / self.noise(jitter)
+        self.static_log = np.sum(np.log(self.static_inv_sigma2))
+
+    def noise(self, jitter):
+        # Data variances with each rv point's instrument jitter added
+        variance = self.variance.copy()
+        variance[self.nflux:] += jitter[self.instrument] ** 2
+
+        return variance
+
+    def noise_parameters(self):
+        # ferr_frac and the offset and jitter of each instrument, from the
+        # current parameter values
+        values = self._values()
+
+        return (values[self.ferr_index], values[self.offset_index],
+                values[self.jitter_index])
+
+    def rv_offset(self):
+        # Offset of each rv point, from the current parameter values
+        return self._values()[self.offset_index][self.instrument]
+
+    def residuals(self, mod_flux, mod_rv):
+        # Data minus model for the photometry and the rv data (with the
+        # instrument offsets added to the model), as one vector
+        values = self._values()
+
+        self.model[:self.nflux] = mod_flux
+        np.add(mod_rv, values[self.offset_index][self.instrument],
+               out=self.model[self.nflux:])
+
+        return np.subtract(self.y, self.model, out=self.resid)
+
+    def chisq(self, mod_flux, mod_rv):
+        resid = self.residuals(mod_flux, mod_rv)
+
+        return np.sum(resid ** 2 / self.variance)
+
+    def __call__(self, mod_flux, mod_rv):
+        values = self._values()
+        resid = self.residuals(mod_flux, mod_rv)
+        f, jitter = values[self.ferr_index], values[self.jitter_index]
+
+        if f == 0.0:
+            if self.jitter is None or not np.array_equal(jitter, self.jitter):
+                self._cache(jitter)
+
+            inv_sigma2, log_term = self.static_inv_sigma2, self.static_log
+        else:
+            # The photometric errors scale with the model flux
+            inv_sigma2 = self.inv_sigma2
+            inv_sigma2[:] = self.noise(jitter)
+            inv_sigma2[:self.nflux] += (f * self.model[:self.nflux]) ** 2
+            np.divide(1.0, inv_sigma2, out=inv_sigma2)
+            log_term = np.sum(np.log(inv_sigma2))
+
+        return -0.5 * (np.dot(resid * resid, inv_sigma2) - log_term)
@@ -1,32 +1,276 @@
 __author__ = 'nmearl'
 
 from pynamic import photometry, optimizers
+from pynamic.likelihood import Likelihood
+from pynamic.chain import ChainStore, select, last_position
+from pynamic.checkpoint import CheckpointWriter, save_state, load_state
+from collections import OrderedDict
 import numpy as np
+import os
+import threading
 
 
 class Optimizer(object):
     def __init__(self, params, photo_data_file='', rv_data_file='', rv_body=0,
-                 chain_file=''):
+                 chain_file='', photo_exposure=0.0, photo_nsub=1,
+                 etv_data_file='', rv_instruments=None, cache_size=32,
+                 chain_out_file='chain.npy', checkpoint_interval=30.0,
+                 state_file='sampler.pkl', rv_instrument_column=None,
+                 rv_split=None):
         self.params = params
-        self.photo_data = np.loadtxt(photo_data_file,
-                                     unpack=True, usecols=(0, 1, 2))
-        self.rv_data = np.zeros((3, 0))
+        self.rv_body = rv_body
+        self.pool = None
+        self.context = None
+        self.writer = None
+        self.diagnostics = None
+        self.checkpoint_interval = checkpoint_interval
+        self.state_file = state_file
+
+        # Models and likelihoods of the most recently evaluated parameter
+        # values, most recent last
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.lock = threading.RLock()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+        self.photo_exposure = photo_exposure
+        self.nsub = photo_nsub
+        self.rv_instruments = rv_instruments
+        self.rv_split = rv_split
+
+        photo_data = np.zeros((3, 0))
+        rv_data = np.zeros((3, 0))
+        rv_instrument = None
+        etv_data = np.zeros((4, 0))
+
+        if photo_data_file:
+            photo_data = np.loadtxt(photo_data_file,
+                                    unpack=True, usecols=(0, 1, 2))
+
+        # The instrument (0, 1, ...) of each rv point, each with its own
+        # offset and jitter (see Likelihood), is read from column
+        # rv_instrument_column, or from the fourth column if rv_instruments
+        # are named; otherwise any further columns are ignored
+        if rv_instrument_column is None and rv_instruments is not None:
+            rv_instrument_column = 3
 
         if rv_data_file:
-            self.rv_data = np.loadtxt(rv_data_file,
-                                      unpack=True, usecols=(0, 1, 2))
+            rv_data = np.loadtxt(rv_data_file, ndmin=2,
+                                 unpack=True, usecols=(0, 1, 2))
 
-        self.rv_body = rv_body
-        self.chain = np.zeros([1, 1 + len(self.params.get_all(True))])
+            if rv_instrument_column is not None:
+                rv_instrument = np.loadtxt(rv_data_file, ndmin=1,
+                                           usecols=(rv_instrument_column,))
+
+        # Observed mid-eclipse times: time, error, and the indices of the
+        # occulting (front) and occulted (back) body
+        if etv_data_file:
+            etv_data = np.loadtxt(etv_data_file, ndmin=2,
+                                  unpack=True, usecols=(0, 1, 2, 3))
+
+        self.set_data(photo_data, rv_data, rv_instrument, etv_data)
+
+        # Samples (lnp followed by the varying parameters), appended to
+        # chain_out_file as they come in. A chain_file from an earlier run is
+        # only memory-mapped; it is continued if it is also the output file,
+        # and otherwise stands in as the chain until there are new samples.
+        resume = bool(chain_file and chain_out_file) and \
+            os.path.abspath(chain_file) == os.path.abspath(chain_out_file)
+        self.chain_store = ChainStore(1 + len(self.params.get_all(True)),
+                                      chain_out_file or None, append=resume)
+        self.chain_source = None
         self.maxlnp = -np.inf
 
+        if chain_file and not resume:
+            self.chain_source = np.load(chain_file, mmap_mode='r')
+
         if chain_file:
-            self.chain = np.load(chain_file)[975001:, :]
             print(self.chain.shape)
 
+    def set_data(self, photo_data=None, rv_data=None, rv_instrument=None,
+                 etv_data=None):
+        # Replaces the photometric (time, flux, error), rv (time, rv, error)
+        # and eclipse-time data; the ones not given are kept. Anything made
+        # for the old data (model grid, native context, pool, cached models)
+        # is dropped.
+        if photo_data is not None:
+            self.photo_data = np.asarray(photo_data, dtype=np.float64)
+
+        if rv_data is not None:
+            self.rv_data = np.asarray(rv_data, dtype=np.float64)
+            self.rv_instrument = None if rv_instrument is None else \
+                np.asarray(rv_instrument).astype(int)
+
+        if etv_data is not None:
+            self.etv_data = np.asarray(etv_data, dtype=np.float64)
+
+        self.close()
+        self.clear_cache()
+
+        # Evaluate the model on one sorted, de-duplicated grid so the
+        # integrator only ever steps forward, and keep the indices that
+        # scatter the grid back onto the photometric and rv data
+        flux_x, rv_x = self.photo_data[0], self.rv_data[0]
+        self.time, inds = np.unique(np.append(flux_x, rv_x),
+                                    return_inverse=True)
+        self.flux_inds = inds[:flux_x.size]
+        self.rv_inds = inds[flux_x.size:]
+
+        # Photometric points integrate over their exposure (e.g. 29.4 min
+        # for Kepler long cadence), averaged over photo_nsub sub-exposures
+        self.exposure = np.zeros(self.time.size)
+        self.exposure[self.flux_inds] = self.photo_exposure
+
+        self.likelihood = Likelihood(self.params, self.photo_data,
+                                     self.rv_data, self.rv_instrument,
+                                     self.rv_instruments, self.rv_split)
+
+    def clear_cache(self):
+        with self.lock:
+            self.cache.clear()
+
+    def cache_info(self):
+        return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                'size': len(self.cache), 'maxsize': self.cache_size}
+
+    def cached(self, name, compute):
+        # Result name for the current parameter values, computed (and kept,
+        # dropping the least recently used values beyond cache_size) if it
+        # isn't cached yet. Other threads (e.g. a Watcher) may change the
+        # values meanwhile; a result is only kept if they didn't.
+        key = self.params.values.tobytes()
+
+        with self.lock:
+            entry = self.cache.pop(key, {})
+            self.cache[key] = entry
+
+            if name in entry:
+                self.cache_hits += 1
+                return entry[name]
+
+            self.cache_misses += 1
+
+        value = compute()
+
+        with self.lock:
+            if self.params.values.tobytes() == key:
+                self.cache.setdefault(key, {})[name] = value
+
+            while len(self.cache) > self.cache_size:
+                self.cache.popitem(last=False)
+
+        return value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __getstate__(self):
+        # Worker pools and native contexts can't be shipped to other
+        # processes
+        state = self.__dict__.copy()
+        state['pool'] = None
+        state['context'] = None
+        state['writer'] = None
+        state['diagnostics'] = None
+        state['cache'] = OrderedDict()
+        del state['lock']
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.RLock()
+
+    def lightweight(self):
+        # Copy holding only the parameters, the data and what is derived
+        # from them (no chain, pool, context or cache), for evaluating the
+        # likelihood in other processes
+        worker = Optimizer.__new__(Optimizer)
+        worker.__setstate__(self.__getstate__())
+        worker.chain_store = None
+        worker.chain_source = None
+
+        return worker
+
+    def start_pool(self, nprocs=2, kind='process'):
+        self.close()
+        self.model_pool(nprocs, kind)
+
+    def model_pool(self, nprocs=2, kind='process'):
+        # The worker pool that models are computed on when asked for more
+        # than one process; started on first use and kept until close
+        with self.lock:
+            if self.pool is None:
+                self.pool = photometry.ModelPool(self.time, self.rv_body,
+                                                 nprocs, kind,
+                                                 exposure=self.exposure,
+                                                 nsub=self.nsub)
+
+            return self.pool
+
+    def start_checkpoints(self):
+        # From now on, checkpoints are written in the background, at most
+        # every checkpoint_interval seconds
+        if self.writer is None:
+            self.writer = CheckpointWriter(self, self.checkpoint_interval)
+            self.chain_store.deferred = True
+            self.writer.start()
+
+    def stop_checkpoints(self):
+        # Writes the last checkpoint and goes back to writing them directly
+        writer, self.writer = self.writer, None
+
+        if writer is not None:
+            try:
+                writer.stop()
+            finally:
+                self.chain_store.deferred = False
+
+    def checkpoint(self):
+        if self.writer is not None:
+            self.writer.submit(self.params.values)
+        else:
+            self.params.save()
+            self.save()
+
+    def save_state(self, state):
+        # Sampler state to resume from, written to state_file once the chain
+        # rows it accounts for are on disk
+        if self.writer is not None:
+            self.writer.submit(state=state)
+        else:
+            self.chain_store.flush()
+            save_state(self.state_file, state)
+
+    def load_state(self, path=None):
+        # A saved sampler state; the chain is cut back to the rows it accounts
+        # for, and continued from there
+        state = load_state(path or self.state_file)
+        self.chain_store.truncate(state['rows'])
+        self.maxlnp = state['maxlnp']
+
+        return state
+
+    def close(self):
+        self.stop_checkpoints()
+
+        if self.pool is not None:
+            self.pool.close()
+            self.pool = None
+
+        if self.context is not None:
+            self.context.close()
+            self.context = None
+
     def run(self, method=None, **kwargs):
         if method == 'mcmc':
             optimizers.hammer(self, **kwargs)
+        elif method == 'ptmcmc':
+            optimizers.ptmcmc(self, **kwargs)
         elif method == 'multinest':
             optimizers.multinest(self, **kwargs)
         else:
@@ -41,47 +285,143 @@ class Optimizer(object):
             np.savetxt(rv_out_file, mod_rv)
             np.savetxt(chain_out_file, self.chain)
 
-        np.save("chain", self.chain)
+        self.chain_store.flush()
+
+    @property
+    def chain(self):
+        if self.chain_source is not None and not len(self.chain_store):
+            return self.chain_source
+
+        return self.chain_store.array()
+
+    def load_chain(self, path=None, burnin=0, thin=1, nwalkers=None,
+                   walkers=None, dropnan=True, flat=True):
+        # Samples of the chain saved in path, or of the current chain, with
+        # burnin and thinning applied (see chain.select); memory-mapped, so
+        # only the rows that are kept are read
+        chain = np.load(path, mmap_mode='r') if path else self.chain
+
+        return select(chain, burnin, thin, nwalkers, walkers, dropnan, flat)
+
+    def last_position(self, nwalkers, path=None):
+        # Walker positions of the last ensemble step, to resume sampling from
+        chain = np.load(path, mmap_mode='r') if path else self.chain
+
+        return last_position(chain, nwalkers)
 
     def model(self, nprocs=1):
-        flux_x, rv_x = self.photo_data[0], self.rv_data[0]
-        x = np.append(flux_x, rv_x)
+        mod_flux, mod_rv = self.cached('model', lambda: self.compute_model(
+            nprocs))
 
-        flux_inds = np.in1d(x, flux_x, assume_unique=True)
-        rv_inds = np.in1d(x, rv_x, assume_unique=True)
+        # Callers are free to change what they get
+        return mod_flux.copy(), mod_rv.copy()
 
-        mod_flux, mod_rv = photometry.generate(self.params, x,
-                                               self.rv_body, nprocs)
+    def compute_model(self, nprocs=1):
+        if self.pool is not None or nprocs > 1:
+            mod_flux, mod_rv = self.model_pool(nprocs).generate(self.params)
+        else:
+            # The context's buffers are only valid until its next evaluation
+            context = self.model_context()
+
+            with context.lock:
+                mod_flux, mod_rv = context.generate(self.params)
+
+                return mod_flux[self.flux_inds], mod_rv[self.rv_inds]
+
+        return mod_flux[self.flux_inds], mod_rv[self.rv_inds]
+
+    def model_context(self):
+        # The native context, with the data registered with it. It is shared
+        # by all threads, which it serializes (see photometry.Model), and
+        # follows changes to the settings (epoch, step size, tolerances).
+        with self.lock:
+            if self.context is None:
+                context = photometry.Model(self.params, self.time,
+                                           self.rv_body,
+                                           exposure=self.exposure,
+                                           nsub=self.nsub)
+                context.observe(self.flux_inds, self.photo_data[1],
+                                self.photo_data[2], self.rv_inds,
+                                self.likelihood.instrument, self.rv_data[1],
+                                self.rv_data[2])
+                self.context = context
+
+            return self.context
+
+    def model_lnlike(self):
+        # Log-likelihood of the photometry and rv data for the current
+        # parameters, summed in the native code without building the model
+        # arrays in Python
+        def compute():
+            f, offsets, jitters = self.likelihood.noise_parameters()
+            flnl, rvlnl = self.model_context().lnlike(self.params.values, f,
+                                                      offsets, jitters)
+
+            return flnl + rvlnl
+
+        return self.cached('lnlike', compute)
+
+    def model_batch(self, thetas, nthreads=1):
+        mod_flux, mod_rv = photometry.generate_batch(self.params, thetas,
+                                                     self.time, self.rv_body,
+                                                     nthreads,
+                                                     exposure=self.exposure,
+                                                     nsub=self.nsub)
 
-        return mod_flux[flux_inds], mod_rv[rv_inds]
+        return mod_flux[:, self.flux_inds], mod_rv[:, self.rv_inds]
+
+    def model_etv(self):
+        # Predicted time of the eclipse nearest to each observed one of the
+        # same pair of bodies; nan where the model has no such eclipse
+        obs_time, obs_err, obs_front, obs_back = self.etv_data
+        mod_time = np.zeros(obs_time.size) + np.nan
+
+        if not obs_time.size:
+            return mod_time
+
+        front, back, tmid, duration, depth = photometry.eclipse_times(
+            self.params, obs_time.min() - 1.0, obs_time.max() + 1.0)
+
+        for i, j in set(zip(obs_front.astype(int), obs_back.astype(int))):
+            obs = (obs_front == i) & (obs_back == j)
+            pred = tmid[(front == i) & (back == j)]
+
+            if not pred.size:
+                continue
+
+            k = np.clip(np.searchsorted(pred, obs_time[obs]), 1, pred.size - 1)
+            near = k - (np.abs(pred[k - 1] - obs_time[obs]) <
+                        np.abs(pred[k] - obs_time[obs])) if pred.size > 1 else 0
+            mod_time[obs] = pred[near]
+
+        return mod_time
 
     def filled_rv_model(self, input_times, nprocs=1):
+        # Time chunks go to the workers of the model pool
+        pool = self.model_pool(nprocs).pool if nprocs > 1 else None
         mod_flux, mod_rv = photometry.generate(self.params, input_times,
-                                               self.rv_body, nprocs)
+                                               self.rv_body, nprocs,
+                                               pool=pool)
 
         return mod_rv
 
     def update_chain(self, tlnl, theta):
-        nobj = np.append(tlnl, theta)
-        self.chain = np.vstack([self.chain, nobj])
+        # One sample, or a block of them (e.g. a whole ensemble step) given
+        # as arrays of lnp and rows of parameters
+        self.chain_store.append(np.column_stack([np.atleast_1d(tlnl),
+                                                 np.atleast_2d(theta)]))
 
     def redchisq(self):
         mod_flux, mod_rv = self.model()
-        chisq = np.sum(((self.photo_data[1] - mod_flux) /
-                        self.photo_data[2]) ** 2)
-
-        # REMOVE LATER
-        trv_corr = self.params.get("gamma_t").value
-        mrv_corr = self.params.get("gamma_m").value
-
-        chisq += np.sum(((self.rv_data[1][:10] - (mod_rv[:10] + trv_corr)) /
-                         self.rv_data[2][:10]) ** 2)
+        chisq = self.likelihood.chisq(mod_flux, mod_rv)
 
-        chisq += np.sum(((self.rv_data[1][10:] - (mod_rv[10:] + mrv_corr)) /
-                         self.rv_data[2][10:]) ** 2)
+        if self.etv_data[0].size:
+            chisq += np.sum(((self.etv_data[0] - self.model_etv()) /
+                             self.etv_data[1]) ** 2)
 
         deg = len(self.params.get_flat(True))
-        nu = self.photo_data[1].size + self.rv_data[1].size - 1.0 - deg
+        nu = self.photo_data[1].size + self.rv_data[1].size + \
+             self.etv_data[0].size - 1.0 - deg
         # nu = self.photo_data[1].size - 1.0 - deg
         return chisq / nu
 
@@ -91,6 +431,5 @@ class Optimizer(object):
         if improved or not np.isfinite(tlnl):
             if theta is not None:
                 self.params.update(theta)
-                self.params.save()
-                self.save()
+                self.checkpoint()
                 self.maxlnp = tlnl
\ No newline at end of file
@@ -8,51 +8,53 @@ try:
 except:
     pass
 import scipy.optimize as op
+from multiprocessing import Pool
 
 
 def lnprior(dtheta, params):
-    for i in range(len(dtheta)):
-        if not (params[i].min <= dtheta[i] <= params[i].max):
-            # print(params[i].name, params[i].min, dtheta[i], params[i].max)
-            return -np.inf
-
-    return 0.0
+    # Flat priors within the bounds; for rows of dtheta, one value per row
+    return np.where(params.in_bounds(dtheta), 0.0, -np.inf)
 
 
 def lnlike(dtheta, optimizer, nprocs=1):
     optimizer.params.update(dtheta)
-    mod_flux, mod_rv = optimizer.model(nprocs)
 
-    f = optimizer.params.get("ferr_frac").value
-    trv_corr = optimizer.params.get("gamma_t").value
-    mrv_corr = optimizer.params.get("gamma_m").value
+    # Serially, the native context sums the likelihood itself
+    if nprocs == 1 and optimizer.pool is None:
+        tlnl = optimizer.model_lnlike()
+
+        if optimizer.etv_data[0].size:
+            tlnl += etv_lnlike(optimizer)
+
+        return tlnl
 
-    mod_rv[:10] += trv_corr
-    mod_rv[10:] += mrv_corr
+    mod_flux, mod_rv = optimizer.model(nprocs)
 
-    lnf = np.log(f) if f != 0.0 else -np.inf
-    inv_sigma2 = 1.0 / (
-    optimizer.photo_data[2] ** 2 + mod_flux ** 2 * np.exp(2 * lnf))
-    flnl = -0.5 * (np.sum((optimizer.photo_data[1] - mod_flux) ** 2 * inv_sigma2
-                          - np.log(inv_sigma2)))
+    return model_lnlike(optimizer, mod_flux, mod_rv)
 
-    tinv_sigma2 = 1.0 / (
-        optimizer.rv_data[2][:10] ** 2 + mod_rv[:10] ** 2 * np.exp(2 * -np.inf))
-    trvlnl = -0.5 * (np.sum((optimizer.rv_data[1][:10] - mod_rv[:10]) ** 2 *
-                            tinv_sigma2 - np.log(tinv_sigma2)))
 
-    mrinv_sigma2 = 1.0 / (
-        optimizer.rv_data[2][10:] ** 2 + mod_rv[10:] ** 2 * np.exp(2 * -np.inf))
-    mrvlnl = -0.5 * (np.sum((optimizer.rv_data[1][10:] - mod_rv[10:]) ** 2 *
-                            mrinv_sigma2 - np.log(mrinv_sigma2)))
+def model_lnlike(optimizer, mod_flux, mod_rv):
+    tlnl = optimizer.likelihood(mod_flux, mod_rv)
 
-    tlnl = np.sum(flnl) + np.sum(trvlnl) + np.sum(mrvlnl)
+    if optimizer.etv_data[0].size:
+        tlnl += etv_lnlike(optimizer)
 
     return tlnl
 
 
+def etv_lnlike(optimizer):
+    mod_time = optimizer.model_etv()
+
+    # An observed eclipse the model doesn't produce at all
+    if np.any(np.isnan(mod_time)):
+        return -np.inf
+
+    return -0.5 * np.sum(((optimizer.etv_data[0] - mod_time) /
+                          optimizer.etv_data[1]) ** 2)
+
+
 def lnprob(dtheta, optimizer, nprocs=1):
-    lp = lnprior(dtheta, optimizer.params.get_all(True))
+    lp = lnprior(dtheta, optimizer.params)
 
     if not np.isfinite(lp):
         return -np.inf
@@ -60,104 +62,503 @@ def lnprob(dtheta, optimizer, nprocs=1):
     return lp + lnlike(dtheta, optimizer, nprocs)
 
 
-def hammer(optimizer, nwalkers=None, niterations=500, nprocs=1):
-    # Initialize the walkers
-    if not nwalkers:
-        nwalkers = len(optimizer.params.get_flat(can_vary=True)) ** 2
+def lnlike_batch(thetas, optimizer, nthreads=1):
+    # Log-likelihood of each row of thetas, with the models computed in one
+    # native batch; rows outside the bounds aren't evaluated and get -inf
+    lnl = np.zeros(len(thetas)) - np.inf
+    valid = optimizer.params.in_bounds(thetas)
 
-        if nwalkers % 2 != 0.0:
-            nwalkers += 1
+    if np.any(valid):
+        mod_flux, mod_rv = optimizer.model_batch(thetas[valid], nthreads)
 
-    theta = optimizer.params.get_flat(can_vary=True)
-    ndim = len(theta)
-    theta[theta == 0.0] = 1.0e-10
-    pos0 = [theta + theta * 1.0e-3 * np.random.randn(ndim)
-            for i in range(nwalkers)]
+        for k, i in enumerate(np.flatnonzero(valid)):
+            optimizer.params.update(thetas[i])
+            lnl[i] = model_lnlike(optimizer, mod_flux[k], mod_rv[k])
+
+    return lnl
+
+
+def lnprob_batch(thetas, optimizer, nthreads=1):
+    return lnprior(thetas, optimizer.params) + lnlike_batch(thetas, optimizer,
+                                                            nthreads)
+
+
+# Stands in for the sampler's pool so that emcee hands over the whole ensemble
+# at once, which is then evaluated in a single native call.
+class BatchPool(object):
+    def __init__(self, optimizer, nthreads=1):
+        self.optimizer = optimizer
+        self.nthreads = nthreads
+
+    def map(self, func, thetas):
+        return lnprob_batch(np.array(thetas), self.optimizer, self.nthreads)
+
+
+def lnlike_prior(dtheta, optimizer):
+    # (log-likelihood, log-prior) pair, as the tempered sampler needs them;
+    # vectors outside the bounds aren't evaluated
+    lp = lnprior(dtheta, optimizer.params)
+
+    if not np.isfinite(lp):
+        return -np.inf, lp
+
+    return lnlike(dtheta, optimizer), lp
+
+
+def lnlike_prior_batch(thetas, optimizer, nthreads=1):
+    return (lnlike_batch(thetas, optimizer, nthreads),
+            lnprior(thetas, optimizer.params))
+
+
+# Likelihood state of a worker process, set once by the pool initializer
+_worker = None
+
+
+def _init_worker(worker):
+    global _worker
+    _worker = worker
 
-    # Setup the sampler
-    sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob, args=(optimizer,),
-                                    threads=nprocs)
 
-    # Every iteration, save out chain
-    for pos, lnp, state in sampler.sample(pos0, iterations=niterations,
-                                          storechain=False):
-        maxlnprob = np.argmax(lnp)
-        bestpos = pos[maxlnprob, :]
+def _worker_lnprob(dtheta):
+    return lnprob(dtheta, _worker)
 
-        optimizer.iterout(lnp[maxlnprob], bestpos)
 
-        for k in range(pos.shape[0]):
-            if not np.isnan(lnp[k]):
-                optimizer.update_chain(lnp[k], pos[k])
+def _worker_lnlike_prior(dtheta):
+    return lnlike_prior(dtheta, _worker)
 
 
-def minimizer(optimizer, method=None, nprocs=1):
+def worker_pool(optimizer, nprocs):
+    # Process pool whose workers each receive a lightweight copy of the
+    # optimizer once; map _worker_lnprob over it, so each task only carries
+    # its parameter vector
+    return Pool(nprocs, initializer=_init_worker,
+                initargs=(optimizer.lightweight(),))
+
+
+def hammer(optimizer, nwalkers=None, niterations=500, nprocs=1,
+           vectorize=False, pos0=None, resume=False, convergence=None):
+    # Initialize the walkers, unless given their starting positions (e.g.
+    # optimizer.last_position(nwalkers) to continue an earlier run). With
+    # resume (True for the optimizer's state_file, or the path of another
+    # one), an interrupted run continues exactly where its last checkpoint
+    # left off, up to niterations in all. Given a diagnostics.Convergence,
+    # sampling stops early once it finds the run converged.
+    theta = optimizer.params.get_flat(can_vary=True)
+    ndim = len(theta)
+    lnp0, rstate0, iteration = None, None, 0
+    optimizer.diagnostics = convergence
+
+    if resume:
+        state = optimizer.load_state(None if resume is True else resume)
+        pos0, lnp0 = state['pos'], state['lnp']
+        rstate0, iteration = state['rstate'], state['iteration']
+
+    if pos0 is not None:
+        pos0 = np.array(pos0)
+        nwalkers = len(pos0)
+    else:
+        if not nwalkers:
+            nwalkers = ndim ** 2
+
+            if nwalkers % 2 != 0.0:
+                nwalkers += 1
+
+        theta[theta == 0.0] = 1.0e-10
+        pos0 = [theta + theta * 1.0e-3 * np.random.randn(ndim)
+                for i in range(nwalkers)]
+
+    # Setup the sampler, evaluating the whole ensemble in one call if asked
+    pool = None
+
+    if vectorize:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
+                                        args=(optimizer,),
+                                        pool=BatchPool(optimizer, nprocs))
+    elif nprocs > 1:
+        pool = worker_pool(optimizer, nprocs)
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, _worker_lnprob,
+                                        pool=pool)
+    else:
+        sampler = emcee.EnsembleSampler(nwalkers, ndim, lnprob,
+                                        args=(optimizer,))
+
+    # Every iteration, save out chain, whole steps of nwalkers rows so that
+    # walkers and steps can be picked out again (see chain.select), and the
+    # state of the ensemble; checkpoints are written in the background.
+    # Convergence picks up from the steps already in the chain.
+    if convergence is not None:
+        convergence.reset(optimizer.chain_store.array(), nwalkers)
+
+    optimizer.start_checkpoints()
+
+    try:
+        for pos, lnp, rstate in sampler.sample(
+                pos0, lnprob0=lnp0, rstate0=rstate0,
+                iterations=niterations - iteration, storechain=False):
+            maxlnprob = np.argmax(lnp)
+            bestpos = pos[maxlnprob, :]
+
+            optimizer.iterout(lnp[maxlnprob], bestpos)
+
+            optimizer.update_chain(lnp, pos)
+
+            iteration += 1
+            optimizer.save_state({'pos': pos.copy(), 'lnp': lnp.copy(),
+                                  'rstate': rstate, 'iteration': iteration,
+                                  'rows': len(optimizer.chain_store),
+                                  'maxlnp': optimizer.maxlnp})
+
+            if convergence is not None:
+                convergence.add(pos)
+
+                if convergence.due(iteration) and convergence.update():
+                    break
+    finally:
+        optimizer.stop_checkpoints()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+def adapt_ladder(betas, ratios, iteration, lag=10000, time=100):
+    # Moves the temperatures between the coldest and the hottest (which stay
+    # put) so that all adjacent pairs swap equally often (Vousden, Farr &
+    # Mandel 2016). ratios are the swap acceptance fractions of each pair;
+    # the adjustments decay over lag iterations, on a timescale of time.
+    kappa = lag / (iteration + lag) / float(time)
+    temps = 1.0 / betas[:-1]
+    dtemps = np.diff(temps) * np.exp(kappa * (ratios[:-1] - ratios[1:]))
+
+    betas = betas.copy()
+    betas[1:-1] = 1.0 / (temps[0] + np.cumsum(dtemps))
+
+    return betas
+
+
+def tempered(logl, logp, betas):
+    # Log-posterior of each walker of each temperature (rows of logl and
+    # logp), with the likelihood raised to the power beta
+    with np.errstate(invalid='ignore'):
+        return np.where(np.isfinite(logl), betas[:, None] * logl + logp,
+                        -np.inf)
+
+
+def stretch_move(pos, logl, logp, betas, evaluate, a=2.0):
+    # One affine-invariant stretch move (Goodman & Weare 2010) of every
+    # walker of every temperature, in place: each half of the walkers moves
+    # relative to the other half of its own ensemble, and all temperatures
+    # are evaluated together by evaluate, which maps rows of parameter
+    # vectors to their (log-likelihoods, log-priors)
+    ntemps, nwalkers, ndim = pos.shape
+    half = nwalkers // 2
+
+    for first in (0, 1):
+        update = slice(first, None, 2)
+        other = pos[:, 1 - first::2]
+
+        zs = np.exp(np.random.uniform(-np.log(a), np.log(a), (ntemps, half)))
+        js = np.random.randint(0, half, (ntemps, half))
+        partners = other[np.arange(ntemps)[:, None], js]
+        proposal = partners + zs[:, :, None] * (pos[:, update] - partners)
+
+        qlogl, qlogp = evaluate(proposal.reshape(-1, ndim))
+        qlogl = np.reshape(qlogl, (ntemps, half))
+        qlogp = np.reshape(qlogp, (ntemps, half))
+
+        with np.errstate(invalid='ignore'):
+            lnaccept = ndim * np.log(zs) + tempered(qlogl, qlogp, betas) - \
+                tempered(logl[:, update], logp[:, update], betas)
+            accept = np.log(np.random.uniform(size=(ntemps, half))) < lnaccept
+
+        pos[:, update][accept] = proposal[accept]
+        logl[:, update][accept] = qlogl[accept]
+        logp[:, update][accept] = qlogp[accept]
+
+
+def swap_temperatures(pos, logl, logp, betas):
+    # Proposes to swap each walker with a random one of the next colder
+    # temperature, from the hottest pair down, in place; returns the
+    # fraction of accepted swaps of each adjacent pair
+    ntemps, nwalkers = logl.shape
+    ratios = np.zeros(ntemps - 1)
+
+    for i in range(ntemps - 1, 0, -1):
+        hot = np.random.permutation(nwalkers)
+        cold = np.random.permutation(nwalkers)
+
+        with np.errstate(invalid='ignore'):
+            lnaccept = (betas[i - 1] - betas[i]) * (logl[i, hot] -
+                                                    logl[i - 1, cold])
+            accept = np.log(np.random.uniform(size=nwalkers)) < lnaccept
+
+        hot, cold = hot[accept], cold[accept]
+
+        for x in (pos, logl, logp):
+            x[i, hot], x[i - 1, cold] = x[i - 1, cold], x[i, hot].copy()
+
+        ratios[i - 1] = accept.mean()
+
+    return ratios
+
+
+def ptmcmc(optimizer, ntemps=8, nwalkers=None, niterations=500, nprocs=1,
+           vectorize=True, Tmax=None, adapt=True, adaptation_lag=10000,
+           adaptation_time=100, pos0=None, resume=False, convergence=None):
+    # Parallel tempering: ntemps ensembles, from the posterior up to Tmax,
+    # that each take a stretch move and then swap walkers every step. All
+    # temperatures are evaluated together, in one native batch (vectorize)
+    # or on a worker pool (nprocs > 1). With adapt, the ladder is tuned as
+    # the run goes (see adapt_ladder). Only the cold ensemble is recorded in
+    # the chain, as hammer does; checkpoints, resume and convergence work the
+    # same way. Random numbers come from numpy's global generator, whose
+    # state is saved with the rest.
+    theta = optimizer.params.get_flat(can_vary=True)
+    ndim = len(theta)
+    betas, logl, logp, iteration = None, None, None, 0
+    optimizer.diagnostics = convergence
+
+    if resume:
+        state = optimizer.load_state(None if resume is True else resume)
+        pos0, logl, logp = state['pos'], state['lnlike'], state['lnprior']
+        betas, iteration = state['betas'], state['iteration']
+        np.random.set_state(state['rstate'])
+
+    if pos0 is not None:
+        pos0 = np.array(pos0)
+        ntemps, nwalkers = pos0.shape[:2]
+    else:
+        if not nwalkers:
+            nwalkers = ndim ** 2
+
+            if nwalkers % 2 != 0.0:
+                nwalkers += 1
+
+        theta[theta == 0.0] = 1.0e-10
+        pos0 = theta + theta * 1.0e-3 * np.random.randn(ntemps, nwalkers,
+                                                         ndim)
+
+    if nwalkers % 2 != 0:
+        raise ValueError("The number of walkers must be even.")
+
+    if betas is None:
+        betas = emcee.ptsampler.default_beta_ladder(ndim, ntemps, Tmax)
+
+    pool = None
+
+    if vectorize:
+        def evaluate(thetas):
+            return lnlike_prior_batch(thetas, optimizer, nprocs)
+    elif nprocs > 1:
+        pool = worker_pool(optimizer, nprocs)
+
+        def evaluate(thetas):
+            return np.array(pool.map(_worker_lnlike_prior, thetas)).T
+    else:
+        def evaluate(thetas):
+            return np.array([lnlike_prior(x, optimizer) for x in thetas]).T
+
+    pos = pos0.astype(float)
+    betas = np.array(betas, dtype=float)
+
+    if convergence is not None:
+        convergence.reset(optimizer.chain_store.array(), nwalkers)
+
+    optimizer.start_checkpoints()
+
+    try:
+        if logl is None:
+            logl, logp = evaluate(pos.reshape(-1, ndim))
+
+        logl = np.reshape(logl, (ntemps, nwalkers)).astype(float)
+        logp = np.reshape(logp, (ntemps, nwalkers)).astype(float)
+
+        while iteration < niterations:
+            stretch_move(pos, logl, logp, betas, evaluate)
+            ratios = swap_temperatures(pos, logl, logp, betas)
+            iteration += 1
+
+            if adapt:
+                betas = adapt_ladder(betas, ratios, iteration,
+                                     adaptation_lag, adaptation_time)
+
+            lnprob = tempered(logl, logp, betas)
+            maxlnprob = np.argmax(lnprob[0])
+            optimizer.iterout(lnprob[0, maxlnprob], pos[0, maxlnprob])
+            optimizer.update_chain(lnprob[0], pos[0])
+
+            optimizer.save_state({'pos': pos.copy(), 'lnlike': logl.copy(),
+                                  'lnprior': logp.copy(), 'betas': betas,
+                                  'ratios': ratios,
+                                  'rstate': np.random.get_state(),
+                                  'iteration': iteration,
+                                  'rows': len(optimizer.chain_store),
+                                  'maxlnp': optimizer.maxlnp})
+
+            if convergence is not None:
+                convergence.add(pos[0])
+
+                if convergence.due(iteration) and convergence.update():
+                    break
+    finally:
+        optimizer.stop_checkpoints()
+
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+# Gradient of chi2 (-2 lnprob) by central differences, with steps from
+# Parameters.get_steps, to hand to scipy as jac. All 2 * ndim perturbed vectors
+# are evaluated in one go: on a worker pool if given, otherwise in a single
+# native batch on nthreads threads. Where a step would leave the bounds, the
+# one-sided difference on the other side is used, with the value at theta
+# itself taken through lnprob, i.e. usually from the optimizer's cache as the
+# minimizer has just evaluated it.
+class Gradient(object):
+    def __init__(self, optimizer, nthreads=1, pool=None, rel_step=1.0e-6):
+        self.optimizer = optimizer
+        self.nthreads = nthreads
+        self.pool = pool
+        self.rel_step = rel_step
+
+    def evaluate(self, thetas):
+        if self.pool is not None:
+            return np.array(self.pool.map(_worker_lnprob, thetas))
+
+        return lnprob_batch(thetas, self.optimizer, self.nthreads)
+
+    def __call__(self, theta, *args):
+        ndim = len(theta)
+        h = self.optimizer.params.get_steps(theta, self.rel_step)
+        step = np.diag(h)
+
+        chi2 = -2.0 * self.evaluate(np.vstack([theta + step, theta - step]))
+        fp, fm = chi2[:ndim], chi2[ndim:]
+        up, down = np.isfinite(fp), np.isfinite(fm)
+        f0 = np.nan
+
+        if not np.all(up & down):
+            f0 = -2.0 * lnprob(theta, self.optimizer, self.nthreads)
+
+        with np.errstate(invalid='ignore'):
+            return np.where(up & down, (fp - fm) / (2.0 * h),
+                            np.where(up, (fp - f0) / h,
+                                     np.where(down, (f0 - fm) / h, 0.0)))
+
+
+# Methods of scipy.optimize.minimize that use the gradient, or the bounds
+GRADIENT_METHODS = ('CG', 'BFGS', 'NEWTON-CG', 'L-BFGS-B', 'TNC', 'SLSQP',
+                    'TRUST-CONSTR')
+BOUNDED_METHODS = ('L-BFGS-B', 'TNC', 'SLSQP', 'TRUST-CONSTR')
+
+
+def minimizer(optimizer, method=None, nprocs=1, parallel='thread',
+              rel_step=1.0e-6):
+    # Gradient-based methods (and the default one) get the gradient from
+    # Gradient, evaluated on nprocs threads, or processes with
+    # parallel='process'; bounded methods are kept within the parameter
+    # bounds
     chi2 = lambda *args: -2 * lnprob(*args)
     theta = optimizer.params.get_flat(can_vary=True)
-    result = op.minimize(chi2, theta, args=(optimizer, nprocs),
-                         method=method)
-    # bounds=optimizer.params.get_bounds(True))
+    name = (method or '').upper()
+    pool = None
+    kwargs = {}
+
+    if not method or name in GRADIENT_METHODS:
+        if parallel == 'process' and nprocs > 1:
+            pool = worker_pool(optimizer, nprocs)
+
+        kwargs['jac'] = Gradient(optimizer, nprocs, pool, rel_step)
+
+    if name in BOUNDED_METHODS:
+        kwargs['bounds'] = optimizer.params.get_bounds(True, finite=True)
+
+    try:
+        result = op.minimize(chi2, theta, args=(optimizer, nprocs),
+                             method=method, **kwargs)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
     tlnl = -2 * lnlike(result["x"], optimizer)
     optimizer.iterout(tlnl, result["x"])
     optimizer.update_chain(tlnl, result["x"])
 
 
-def multinest(optimizer, nprocs=1):
-    # number of dimensions our problem has
-    parameters = ["{0}".format(i)
-                  for i in range(len(optimizer.params.get_all(True)))]
-    nparams = len(parameters)
-
-    if not os.path.exists('chains'):
-        os.mkdir('chains')
-
-    def lnprior(cube, ndim, nparams):
-        theta = np.array([cube[i] for i in range(ndim)])
-
-        for i in range(len(optimizer.params.get_all(True))):
-            param = optimizer.params.get_all(True)[i]
-
-            if "mass_" in param.name:
-                theta[i] = 10 ** (theta[i] * 8 - 9)
-            elif "radius_" in param.name:
-                theta[i] = 10 ** (theta[i] * 4 - 4)
-            elif "flux_" in param.name:
-                theta[i] = 10 ** (theta[i] * 4 - 4)
-            elif "a_" in param.name:
-                theta[i] = 10 ** (theta[i] * 2 - 2)
-            elif "e_" in param.name:
-                theta[i] = 10 ** (theta[i] * 3 - 3)
-            elif "inc_" in param.name:
-                theta[i] *= 2.0 * np.pi
-            elif "om_" in param.name:
-                theta[i] = 2.0 * np.pi * 10 ** (theta[i] * 2 - 2)
-            elif "ln_" in param.name:
-                theta[i] = 2.0 * np.pi * 10 ** (theta[i] * 8 - 8)
-            elif "ma_" in param.name:
-                theta[i] = 2.0 * np.pi * 10 ** (theta[i] * 2 - 2)
-
-        for i in range(ndim):
-            cube[i] = theta[i]
-
-    def lnlike(cube, ndim, nparams):
-        theta = np.array([cube[i] for i in range(ndim)])
-
-        optimizer.params.update(theta)
-        mod_flux, mod_rv = optimizer.model(nprocs)
-
-        flnl = -(0.5 * ((mod_flux - optimizer.photo_data[1]) /
-                        optimizer.photo_data[2]) ** 2)
-        rvlnl = -(0.5 * ((mod_rv - optimizer.rv_data[1]) /
-                         optimizer.rv_data[2]) ** 2)
-        tlnl = np.sum(flnl) + np.sum(rvlnl)
-
-        nobj = np.append(np.sum(flnl) + np.sum(rvlnl), theta)
-        optimizer.chain = np.vstack([optimizer.chain, nobj])
+# Transforms of the unit cube onto each kind of parameter, picked by the prefix
+# of the parameter's name (up to and including the first '_'): whether it is
+# logarithmic, its scale, width and offset, i.e.
+# scale * 10 ** (width * u + offset), or scale * u if linear. The rv offsets
+# (gamma_) keep the a_ transform they always got.
+PRIOR_TRANSFORMS = [
+    ('mass_', True, 1.0, 8.0, -9.0),
+    ('radius_', True, 1.0, 4.0, -4.0),
+    ('flux_', True, 1.0, 4.0, -4.0),
+    ('a_', True, 1.0, 2.0, -2.0),
+    ('e_', True, 1.0, 3.0, -3.0),
+    ('inc_', False, 2.0 * np.pi, 1.0, 0.0),
+    ('om_', True, 2.0 * np.pi, 2.0, -2.0),
+    ('ln_', True, 2.0 * np.pi, 8.0, -8.0),
+    ('ma_', True, 2.0 * np.pi, 2.0, -2.0),
+    ('gamma_', True, 1.0, 2.0, -2.0),
+]
+
+
+def prior_table(params):
+    # Transform of each varying parameter, as arrays of (log, scale, width,
+    # offset); parameters of no known kind are taken as is
+    transforms = dict((x[0], x[1:]) for x in PRIOR_TRANSFORMS)
+    table = [transforms.get(param.name.split('_')[0] + '_',
+                            (False, 1.0, 1.0, 0.0))
+             for param in params.get_all(True)]
+
+    log, scale, width, offset = (np.array(x) for x in zip(*table))
+
+    return log.astype(bool), scale, width, offset
+
+
+def prior_transform(cube, table):
+    log, scale, width, offset = table
+    x = width * cube + offset
+
+    return scale * np.where(log, 10 ** np.where(log, x, 0.0), cube)
+
+
+def multinest(optimizer, nprocs=1, basename='chains/1-', n_live_points=1000):
+    # The samples are recorded by MultiNest itself, under basename; the
+    # equally weighted posterior samples are added to the chain at the end
+    nparams = len(optimizer.params.get_all(True))
+    table = prior_table(optimizer.params)
+
+    if not os.path.exists(os.path.dirname(basename) or '.'):
+        os.makedirs(os.path.dirname(basename))
+
+    def prior(cube, ndim, nparams):
+        theta = np.ctypeslib.as_array(cube, shape=(ndim,))
+        theta[:] = prior_transform(theta, table)
+
+    # The same likelihood as the other samplers (with ferr_frac and the rv
+    # offsets and jitters), rather than the plain chi2 used before
+    def loglike(cube, ndim, nparams):
+        theta = np.ctypeslib.as_array(cube, shape=(ndim,)).copy()
+        tlnl = lnlike(theta, optimizer, nprocs)
 
         if tlnl > optimizer.maxlnp:
-            optimizer.iterout(tlnl, theta, mod_flux)
+            optimizer.iterout(tlnl, theta)
 
-        return np.sum(flnl) + np.sum(rvlnl)
+        return tlnl
 
     # run MultiNest
-    pymultinest.run(lnlike, lnprior, nparams, n_live_points=1000)
\ No newline at end of file
+    optimizer.start_checkpoints()
+
+    try:
+        pymultinest.run(loglike, prior, nparams, outputfiles_basename=basename,
+                        n_live_points=n_live_points)
+    finally:
+        optimizer.stop_checkpoints()
+
+    samples = np.loadtxt(basename + 'post_equal_weights.dat', ndmin=2)
+    optimizer.update_chain(samples[:, -1], samples[:, :-1])
+    optimizer.save()
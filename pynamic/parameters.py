@@ -2,17 +2,70 @@ __author__ = 'nmearl'
 
 from collections import OrderedDict
 import numpy as np
+from pynamic.checkpoint import atomic_open
+
+
+# Per-body and per-orbit groups of the model parameters, in the order the
+# native code takes them
+BODY_GROUPS = ('mass', 'radius', 'flux', 'u1', 'u2')
+ORBIT_GROUPS = ('a', 'e', 'inc', 'om', 'ln', 'ma')
 
 
 class Parameters(object):
 
     def __init__(self, input_file):
         self.odict = OrderedDict()
+
+        # Values, bounds and vary flags of all parameters live in these
+        # arrays (in input order); the Parameter objects are views onto them
+        self.values = np.zeros(0)
+        self.mins = np.zeros(0)
+        self.maxs = np.zeros(0)
+        self.varies = np.zeros(0, dtype=bool)
+
         self._read_input(input_file)
 
         if "ferr_frac" not in self.odict.keys():
             self.add("ferr_frac", 0.0, 0.0, 1.0, False)
 
+        # Largest interpolation error (AU) of the dense-output integrator;
+        # zero steps the integrator to every requested time instead
+        if "dense_error" not in self.odict.keys():
+            self.add("dense_error", 0.0, 0.0, np.inf, False)
+
+        # Only compute occultations when two bodies are within (1 + margin)
+        # times the sum of their radii on the sky; zero always computes them.
+        # The orbits are integrated just the same, so this only saves the
+        # cost of the occultations.
+        if "window_margin" not in self.odict.keys():
+            self.add("window_margin", 0.0, 0.0, np.inf, False)
+
+    def _index(self):
+        # Positions of the varying parameters and of each physical group in
+        # the arrays, so that updates, bound checks and the model vector are
+        # plain array operations
+        names = list(self.odict.keys())
+        self.free = np.flatnonzero(self.varies)
+        self.groups = {}
+        self.model_index = None
+
+        if "nbodies" not in self.odict:
+            return
+
+        N = int(self.get("nbodies").value)
+
+        for prefix, first in ([(x, 0) for x in BODY_GROUPS] +
+                              [(x, 1) for x in ORBIT_GROUPS]):
+            keys = ['{0}_{1}'.format(prefix, i) for i in range(first, N)]
+
+            if all(key in self.odict for key in keys):
+                self.groups[prefix] = np.array([names.index(key)
+                                                for key in keys], dtype=int)
+
+        if len(self.groups) == len(BODY_GROUPS) + len(ORBIT_GROUPS):
+            self.model_index = np.concatenate(
+                [self.groups[x] for x in BODY_GROUPS + ORBIT_GROUPS])
+
     def _read_input(self, input_file):
         with open(input_file, 'r') as f:
             for line in f:
@@ -27,62 +80,153 @@ class Parameters(object):
                          vary=bool(int(line[4])))
 
     def add(self, name, initvalue, min=-np.inf, max=np.inf, vary=True):
-        param = Parameter(name, initvalue, min, max, vary)
+        if name in self.odict:
+            index = self.odict[name].index
+        else:
+            index = self.values.size
+            self.values = np.append(self.values, 0.0)
+            self.mins = np.append(self.mins, 0.0)
+            self.maxs = np.append(self.maxs, 0.0)
+            self.varies = np.append(self.varies, False)
+
+        self.values[index] = initvalue
+        self.mins[index] = min
+        self.maxs[index] = max
+        self.varies[index] = vary
+
+        param = Parameter(name, initvalue, self, index)
         self.odict[name] = param
+        self._index()
 
     def get(self, name='', index=0):
         if name:
             return self.odict[name]
 
-        return self.odict.items()[index][1]
+        return list(self.odict.values())[index]
 
     def get_flat(self, can_vary=False, quantile=False):
         if can_vary and quantile:
             return np.array([x.quantile_value
                              for x in self.odict.values() if x.vary])
         elif can_vary:
-            return np.array([x.value for x in self.odict.values() if x.vary])
+            return self.values[self.free]
 
-        return np.array([x.value for x in self.odict.values()])
+        return self.values.copy()
 
     def get_all(self, can_vary=False):
         if can_vary:
             return [x for x in self.odict.values() if x.vary]
 
-        return self.odict.values()
+        return list(self.odict.values())
 
-    def get_bounds(self, can_vary=False):
-        if can_vary:
-            return [(x.min, x.max) for x in self.odict.values() if x.vary]
+    def get_bounds(self, can_vary=False, finite=False):
+        # (min, max) of each parameter; with finite, infinite bounds are None
+        # as the scipy minimizers expect
+        inds = self.free if can_vary else slice(None)
+        bounds = zip(self.mins[inds], self.maxs[inds])
+
+        if finite:
+            return [tuple(x if np.isfinite(x) else None for x in bound)
+                    for bound in bounds]
+
+        return list(bounds)
 
-        return [(x.min, x.max) for x in self.odict.values()]
+    def get_steps(self, theta=None, rel_step=1.0e-6):
+        # Finite-difference step of each varying parameter at theta (by
+        # default the current values): rel_step of the parameter's size,
+        # never more than rel_step of its range; parameters at zero use the
+        # range, or one if unbounded
+        theta = self.values[self.free] if theta is None else theta
+        span = self.maxs[self.free] - self.mins[self.free]
+        span = np.where(np.isfinite(span) & (span > 0.0), span, 1.0)
+
+        scale = np.where(theta != 0.0, np.minimum(np.abs(theta), span), span)
+
+        return rel_step * scale
+
+    def get_group(self, prefix, flat=None):
+        # Values of one physical group (e.g. 'mass' or 'inc'), from the
+        # current values or from a full parameter vector (or rows of them)
+        flat = self.values if flat is None else flat
+
+        return flat[..., self.groups[prefix]]
 
     def update(self, theta):
-        for i in range(len(theta)):
-            p = self.get_all(True)[i]
-            p.value = theta[i]
+        self.values[self.free] = theta
+
+    def expand(self, thetas):
+        # Full parameter vectors with the varying entries taken from each row
+        # of thetas
+        thetas = np.atleast_2d(thetas)
+        flat = np.tile(self.values, (thetas.shape[0], 1))
+        flat[:, self.free] = thetas
 
-    def save(self):
-        with open("current.out", "w") as f:
+        return flat
+
+    def in_bounds(self, theta):
+        # Whether the varying parameters in theta (or in each of its rows)
+        # lie within their bounds
+        return np.all((self.mins[self.free] <= theta) &
+                      (theta <= self.maxs[self.free]), axis=-1)
+
+    def save(self, path="current.out", values=None):
+        # Writes the parameters (with values, e.g. a snapshot of them, in
+        # place of the current ones) to a temporary file and moves it over
+        # path
+        values = self.values if values is None else values
+
+        with atomic_open(path) as f:
             for param in self.odict.values():
                 f.write("{0:12s} {1} {2:12g} {3:12g} {4:4d}\n".format(
-                    param.name, param.value, param.min, param.max, param.vary
+                    param.name, values[param.index], param.min, param.max,
+                    param.vary
                 ))
 
 
 class Parameter(object):
 
-    def __init__(self, name, value, min, max, vary):
+    def __init__(self, name, value, owner, index):
         self.name = name
         self.initvalue = value
-        self.value = value
-        self.min = min
-        self.max = max
-        self.vary = vary
+        self.owner = owner
+        self.index = index
         self.upper_error = 0.0
         self.lower_error = 0.0
         self.quantile_value = 0.0
 
+    @property
+    def value(self):
+        return self.owner.values[self.index]
+
+    @value.setter
+    def value(self, value):
+        self.owner.values[self.index] = value
+
+    @property
+    def min(self):
+        return self.owner.mins[self.index]
+
+    @min.setter
+    def min(self, value):
+        self.owner.mins[self.index] = value
+
+    @property
+    def max(self):
+        return self.owner.maxs[self.index]
+
+    @max.setter
+    def max(self, value):
+        self.owner.maxs[self.index] = value
+
+    @property
+    def vary(self):
+        return bool(self.owner.varies[self.index])
+
+    @vary.setter
+    def vary(self, value):
+        self.owner.varies[self.index] = value
+        self.owner._index()
+
     def get_real(self):
         if "mass" in self.name:
             return self.value / 2.959122E-4
@@ -96,24 +240,23 @@ class Parameter(object):
         else:
             return self.value
 
-    def get_real_quantile(self):
+    def get_scale(self):
+        # Factor that converts the value to the units it is reported in
         if "mass" in self.name:
-            return np.array([self.quantile_value,
-                             self.upper_error, self.lower_error]) / 2.959122E-4
+            return 1.0 / 2.959122E-4
         elif "radius" in self.name:
-            return np.array([self.quantile_value,
-                             self.upper_error, self.lower_error]) * 215.1
+            return 215.1
         elif "gamma" in self.name:
-            return np.array([self.quantile_value,
-                             self.upper_error, self.lower_error]) / 5.775e-4
+            return 1.0 / 5.775e-4
         elif ("inc" in self.name or "om" in self.name or "ln" in self.name
               or "ma_" in self.name[:3]):
-            return np.rad2deg(np.array([self.quantile_value,
-                                        self.upper_error, self.lower_error]))
+            return 180.0 / np.pi
         else:
-            return np.array([self.quantile_value,
-                             self.upper_error, self.lower_error])
+            return 1.0
 
+    def get_real_quantile(self):
+        return np.array([self.quantile_value, self.upper_error,
+                         self.lower_error]) * self.get_scale()
 
     def __repr__(self):
         return "{0:12} {1:12g} {2:12g} {3:12g} {4:6}".format(self.name,
@@ -4,7 +4,9 @@ import ctypes
 import numpy as np
 from numpy.ctypeslib import ndpointer
 import sys
-from multiprocessing import Pool
+import threading
+from multiprocessing import Pool, RawArray
+from multiprocessing.pool import ThreadPool
 import os
 
 path = os.path.dirname(os.path.realpath(__file__)).split('/')[:-1]
@@ -20,17 +22,118 @@ else:
 start = lib.start
 
 start.argtypes = [
+    ndpointer(ctypes.c_double),
+    ctypes.c_int,
+    ndpointer(ctypes.c_double),
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ctypes.c_int
+]
+
+start_batch = lib.start_batch
+
+start_batch.argtypes = [
+    ndpointer(ctypes.c_double),
+    ctypes.c_int,
+    ndpointer(ctypes.c_double),
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_int,
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ctypes.c_int,
+    ctypes.c_int
+]
+
+checkpoint = lib.checkpoint
+
+checkpoint.argtypes = [
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS')
+]
+
+start_from = lib.start_from
+
+start_from.argtypes = [
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ctypes.c_int,
     ndpointer(ctypes.c_double),
     ctypes.c_int,
     ctypes.c_int,
     ctypes.c_double,
     ctypes.c_double,
     ctypes.c_double,
+    ctypes.c_double,
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
+    ctypes.c_int
+]
+
+eclipses = lib.eclipses
+
+eclipses.restype = ctypes.c_int
+eclipses.argtypes = [
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_int,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
@@ -39,71 +142,475 @@ start.argtypes = [
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
     ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ctypes.c_int,
+    ndpointer(ctypes.c_int),
+    ndpointer(ctypes.c_int),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double),
+    ndpointer(ctypes.c_double)
+]
+
+
+model_create = lib.model_create
+
+model_create.restype = ctypes.c_void_p
+model_create.argtypes = [
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ctypes.c_int,
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ctypes.c_int,
+    ctypes.c_int,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
     ctypes.c_int
 ]
 
+model_settings = lib.model_settings
+
+model_settings.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double,
+    ctypes.c_double
+]
+
+model_evaluate = lib.model_evaluate
+
+model_evaluate.argtypes = [
+    ctypes.c_void_p,
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS')
+]
+
+model_observe = lib.model_observe
+
+model_observe.argtypes = [
+    ctypes.c_void_p,
+    ctypes.c_int,
+    ndpointer(ctypes.c_int, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ctypes.c_int,
+    ndpointer(ctypes.c_int, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_int, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS')
+]
+
+model_lnlike = lib.model_lnlike
+
+model_lnlike.argtypes = [
+    ctypes.c_void_p,
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ctypes.c_double,
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS'),
+    ndpointer(ctypes.c_double, flags='C_CONTIGUOUS')
+]
+
+model_destroy = lib.model_destroy
+
+model_destroy.argtypes = [ctypes.c_void_p]
+
 
 def run(inputs):
-    time, time_size, \
-    N, t0, maxh, orbit_error, \
-    masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma, \
-    sub_flux, sub_rv, rv_body = inputs
+    time, time_size, texp, nsub = inputs[:4]
+    sub_flux, sub_rv, rv_body, snapshot = inputs[-4:]
 
-    start(
-        time, time_size,
+    N, t0, maxh, orbit_error, dense_error, window_margin, \
+    masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma = inputs[4:-4]
+
+    # A snapshot resumes the integration from there instead of the epoch
+    if snapshot is not None:
+        start_from(
+            snapshot, time, time_size, texp, nsub,
+            N, maxh, orbit_error, dense_error, window_margin,
+            masses, radii, fluxes, u1, u2,
+            sub_flux, sub_rv, rv_body
+        )
+    else:
+        start(
+            time, time_size, texp, nsub,
+            N, t0, maxh, orbit_error, dense_error, window_margin,
+            masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma,
+            sub_flux, sub_rv, rv_body
+        )
+
+    return sub_flux, sub_rv
+
+
+def checkpoints(system, time):
+    N, t0, maxh, orbit_error, dense_error, window_margin, \
+    masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma = system
+
+    time = np.ascontiguousarray(time, dtype=np.float64)
+    snapshots = np.zeros((len(time), 1 + 6 * N))
+
+    checkpoint(
+        time, len(time),
         N, t0, maxh, orbit_error,
-        masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma,
-        sub_flux, sub_rv, rv_body
+        masses, a, e, inc, om, ln, ma,
+        snapshots
     )
 
-    return sub_flux, sub_rv
+    return snapshots
+
+
+def chunk_snapshots(system, time_chunks, texp_chunks):
+    # Hand every chunk the integrator state at the start of its first
+    # exposure, so each one only integrates its own segment. Empty chunks
+    # (more processes than times) come last and simply get no snapshot.
+    starts = [x[0] - y[0] / 2 for x, y in zip(time_chunks, texp_chunks)
+              if len(x)]
+    snapshots = list(checkpoints(system, starts))
 
+    return snapshots + [None] * (len(time_chunks) - len(starts))
 
-def generate(params, time, rv_body, nprocs=1):
-    N, t0, maxh, orbit_error = (int(params.get('nbodies').value),
-                                params.get('epoch').value,
-                                params.get('max_h').value,
-                                params.get('orbit_error').value)
-
-    masses = np.array([params.get('mass_{0}'.format(i)).value
-                       for i in range(N)])
-    radii = np.array([params.get('radius_{0}'.format(i)).value
-                      for i in range(N)])
-    fluxes = np.array([params.get('flux_{0}'.format(i)).value
-                       for i in range(N)])
-    u1 = np.array([params.get('u1_{0}'.format(i)).value for i in range(N)])
-    u2 = np.array([params.get('u2_{0}'.format(i)).value for i in range(N)])
-    a = np.array([params.get('a_{0}'.format(i)).value for i in range(1, N)])
-    e = np.array([params.get('e_{0}'.format(i)).value for i in range(1, N)])
-    inc = np.array([params.get('inc_{0}'.format(i)).value for i in range(1, N)])
-    om = np.array([params.get('om_{0}'.format(i)).value for i in range(1, N)])
-    ln = np.array([params.get('ln_{0}'.format(i)).value for i in range(1, N)])
-    ma = np.array([params.get('ma_{0}'.format(i)).value for i in range(1, N)])
 
+def unpack(params):
+    N, t0, maxh, orbit_error, dense_error, window_margin = (
+        int(params.get('nbodies').value),
+        params.get('epoch').value,
+        params.get('max_h').value,
+        params.get('orbit_error').value,
+        params.get('dense_error').value,
+        params.get('window_margin').value)
+
+    masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma = np.split(
+        params.values[params.model_index], model_sections(N))
+
+    return (N, t0, maxh, orbit_error, dense_error, window_margin,
+            masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma)
+
+
+def model_sections(N):
+    # Where each of the eleven groups starts in the model vector (masses,
+    # radii, fluxes, u1 and u2 of each body, then a, e, inc, om, ln and ma of
+    # each orbit), as laid out by params.model_index
+    return np.cumsum([N] * 5 + [N - 1] * 5)
+
+
+def exposures(time, exposure=0.0):
+    # Exposure time of each point, from a scalar or one value per point; zero
+    # evaluates the model at the instant instead of averaging over the
+    # sub-exposures
+    return np.ascontiguousarray(np.zeros(len(time)) + exposure,
+                                dtype=np.float64)
+
+
+def generate(params, time, rv_body, nprocs=1, checkpoint=True, exposure=0.0,
+             nsub=1, pool=None):
+    # Model on time, split into nprocs chunks that are mapped over pool (an
+    # existing process or thread pool, e.g. a ModelPool's) if given, and
+    # otherwise computed in turn. Repeated evaluations on one grid should use
+    # a ModelPool instead.
+    system = unpack(params)
+
+    # The native code walks the raw buffer, so strided views (e.g. columns
+    # from np.loadtxt(..., unpack=True)) have to be copied first
+    time = np.ascontiguousarray(time, dtype=np.float64)
     time_chunks = np.array_split(time, nprocs)
+    texp_chunks = np.array_split(exposures(time, exposure), nprocs)
+
+    if nprocs > 1 and checkpoint:
+        snapshots = chunk_snapshots(system, time_chunks, texp_chunks)
+    else:
+        snapshots = [None] * nprocs
 
     inputs = [
+        [time_chunks[i], len(time_chunks[i]), texp_chunks[i], nsub] +
+        list(system) +
         [
-            time_chunks[i], len(time_chunks[i]),
-            N, t0, maxh, orbit_error,
-            masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma,
             np.zeros(len(time_chunks[i])),
             np.zeros(len(time_chunks[i])),
-            rv_body
+            rv_body,
+            snapshots[i]
         ]
         for i in range(nprocs)
     ]
 
-    if nprocs > 1:
-        p = Pool(nprocs)
+    if pool is not None:
+        result = pool.map(run, inputs)
+    else:
+        result = list(map(run, inputs))
 
-        result = p.map(run, inputs)
+    sub_fluxes, sub_rvs = zip(*result)
 
-        p.close()
-        p.join()
-    else:
-        result = map(run, inputs)
+    return np.concatenate(sub_fluxes), np.concatenate(sub_rvs)
+
+
+# Time grids and output buffers of the live pools, keyed by pool id. Worker
+# processes receive theirs once through the pool initializer; thread pools
+# share the entry of the parent process.
+_shared = {}
+
+
+def _init_worker(key, time, texp, flux, rv):
+    _shared[key] = tuple(np.frombuffer(x) for x in (time, texp, flux, rv))
+
+
+def _run_chunk(inputs):
+    key, lo, hi, nsub, rv_body, system, snapshot = inputs
+    time, texp, flux, rv = _shared[key]
+
+    # Slices of the shared buffers are contiguous, so the native code writes
+    # its results straight into shared memory
+    run([time[lo:hi], hi - lo, texp[lo:hi], nsub] + list(system) +
+        [flux[lo:hi], rv[lo:hi], rv_body, snapshot])
+
+
+# Long-lived workers evaluating the model on a fixed time grid. The time grid
+# and the output buffers live in shared memory, so each call only ships the
+# system parameters to the workers. With kind='thread' the native code runs on
+# threads of this process instead (ctypes releases the GIL while it runs).
+# Shut down with close(), or use the pool as a context manager.
+class ModelPool(object):
+    def __init__(self, time, rv_body, nprocs=2, kind='process',
+                 checkpoint=True, exposure=0.0, nsub=1):
+        self.rv_body = rv_body
+        self.nprocs = nprocs
+        self.kind = kind
+        self.checkpoint = checkpoint
+        self.nsub = nsub
+        self.key = id(self)
+
+        time = np.asarray(time, dtype=np.float64)
+        shared = [RawArray('d', len(time)) for i in range(4)]
+        np.frombuffer(shared[0])[:] = time
+        np.frombuffer(shared[1])[:] = exposures(time, exposure)
+
+        self.time, self.texp, self.flux, self.rv = [np.frombuffer(x)
+                                                    for x in shared]
+
+        bounds = np.cumsum([0] + [len(x) for x in
+                                  np.array_split(time, nprocs)])
+        self.bounds = list(zip(bounds[:-1], bounds[1:]))
+
+        if kind == 'thread':
+            _init_worker(self.key, *shared)
+            self.pool = ThreadPool(nprocs)
+        elif kind == 'process':
+            self.pool = Pool(nprocs, initializer=_init_worker,
+                             initargs=[self.key] + shared)
+        else:
+            raise ValueError("Unknown pool kind '{0}'.".format(kind))
+
+    def generate(self, params):
+        system = unpack(params)
+
+        if self.checkpoint:
+            snapshots = chunk_snapshots(system,
+                                        [self.time[lo:hi]
+                                         for lo, hi in self.bounds],
+                                        [self.texp[lo:hi]
+                                         for lo, hi in self.bounds])
+        else:
+            snapshots = [None] * len(self.bounds)
+
+        self.pool.map(_run_chunk, [(self.key, lo, hi, self.nsub, self.rv_body,
+                                    system, snapshot)
+                                   for (lo, hi), snapshot in
+                                   zip(self.bounds, snapshots)])
+
+        return self.flux.copy(), self.rv.copy()
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+        _shared.pop(self.key, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def generate_batch(params, thetas, time, rv_body, nthreads=1, exposure=0.0,
+                   nsub=1):
+    N, t0, maxh, orbit_error, dense_error, window_margin = (
+        int(params.get('nbodies').value),
+        params.get('epoch').value,
+        params.get('max_h').value,
+        params.get('orbit_error').value,
+        params.get('dense_error').value,
+        params.get('window_margin').value)
+
+    # Expand each row of varying parameters into a full parameter set
+    flat = params.expand(thetas)
+    nsets = flat.shape[0]
+
+    masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma = [
+        np.ascontiguousarray(x) for x in
+        np.split(flat[:, params.model_index], model_sections(N), axis=1)]
+
+    time = np.ascontiguousarray(time, dtype=np.float64)
+    mod_flux = np.zeros((nsets, len(time)))
+    mod_rv = np.zeros((nsets, len(time)))
+
+    start_batch(
+        time, len(time), exposures(time, exposure), nsub,
+        N, t0, maxh, orbit_error, dense_error, window_margin, nsets,
+        masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma,
+        mod_flux, mod_rv, rv_body, nthreads
+    )
+
+    return mod_flux, mod_rv
+
+
+def eclipse_times(params, tstart, tend, step=None, max_events=10000):
+    # Mid-eclipse times, durations (first to last contact) and depths of every
+    # eclipse between tstart and tend, from a single integration. front and
+    # back are the indices of the occulting and the occulted body. The step
+    # used to search for conjunctions defaults to the maximum integrator step
+    # and has to stay well below the shortest orbital period.
+    N, t0, maxh, orbit_error, dense_error, window_margin, \
+    masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma = unpack(params)
+
+    front = np.zeros(max_events, dtype=np.int32)
+    back = np.zeros(max_events, dtype=np.int32)
+    tmid = np.zeros(max_events)
+    duration = np.zeros(max_events)
+    depth = np.zeros(max_events)
+
+    count = eclipses(
+        tstart, tend, step or maxh,
+        N, t0, maxh, orbit_error, dense_error,
+        masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma,
+        max_events, front, back, tmid, duration, depth
+    )
+
+    return (front[:count], back[:count], tmid[:count], duration[:count],
+            depth[:count])
+
+
+# Settings of the integration, read from the parameters on every evaluation
+SETTINGS = ('epoch', 'max_h', 'orbit_error', 'dense_error', 'window_margin')
+
+
+# Native model context on a fixed time grid. The grid and the output buffers
+# are handed to the native code once; each evaluation then only passes a flat
+# parameter vector, and the results are written straight into self.flux and
+# self.rv, which are overwritten by the next call. The settings (epoch, step
+# size, tolerances) are taken from the same vector and only passed on when
+# they change. With the observations registered through observe, lnlike
+# returns the photometric and rv log-likelihood terms summed in the native
+# code. Free the native side with close().
+#
+# A context can only run one evaluation at a time; calls take lock, which
+# callers that read self.flux and self.rv afterwards should hold as well.
+class Model(object):
+    def __init__(self, params, time, rv_body, exposure=0.0, nsub=1):
+        # Set first, so close (and __del__) work even if creation fails
+        self.lock = threading.RLock()
+        self.handle = None
+
+        N = int(params.get('nbodies').value)
+
+        self.time = np.ascontiguousarray(time, dtype=np.float64)
+        self.texp = exposures(self.time, exposure)
+        self.flux = np.zeros(len(self.time))
+        self.rv = np.zeros(len(self.time))
+        self.columns = params.model_index
+        self.theta = np.zeros(len(self.columns))
+        self.terms = np.zeros(2)
+        self.observed = None
+
+        self.settings_index = np.array([params.get(name).index
+                                        for name in SETTINGS])
+        self.settings = params.values[self.settings_index]
+
+        t0, maxh, orbit_error, dense_error, window_margin = self.settings
+
+        self.handle = model_create(
+            self.time, len(self.time), self.texp, nsub,
+            N, t0, maxh, orbit_error, dense_error, window_margin,
+            self.flux, self.rv, rv_body
+        )
+
+    def _prepare(self, flat):
+        # Loads the model parameters of flat, and its settings if changed
+        settings = flat[self.settings_index]
+
+        if not np.array_equal(settings, self.settings):
+            model_settings(self.handle, *settings)
+            self.settings = settings
+
+        np.take(flat, self.columns, out=self.theta)
+
+    def evaluate(self, flat):
+        # flat is the full parameter vector, as from params.get_flat()
+        with self.lock:
+            self._prepare(flat)
+            model_evaluate(self.handle, self.theta)
+
+        return self.flux, self.rv
+
+    def generate(self, params):
+        return self.evaluate(params.values)
+
+    def observe(self, flux_index, flux_y, flux_e, rv_index, rv_instrument,
+                rv_y, rv_e):
+        # Observed photometry and rv data, each point given by the index of
+        # its time in the grid; rv points also by their instrument (0, 1, ...)
+        def ints(x):
+            return np.ascontiguousarray(x, dtype=np.int32)
+
+        def doubles(x):
+            return np.ascontiguousarray(x, dtype=np.float64)
+
+        # The native side keeps its own copy
+        model_observe(self.handle,
+                      len(flux_index), ints(flux_index), doubles(flux_y),
+                      doubles(flux_e),
+                      len(rv_index), ints(rv_index), ints(rv_instrument),
+                      doubles(rv_y), doubles(rv_e))
+
+        self.observed = len(flux_index), len(rv_index)
+
+    def lnlike(self, flat, ferr_frac=0.0, rv_offsets=None, rv_jitters=None):
+        # Photometric and rv log-likelihood terms for the full parameter
+        # vector flat; offsets and jitters are given per rv instrument
+        if self.observed is None:
+            raise ValueError("No observations registered; call observe "
+                             "first.")
+
+        rv_offsets = np.ascontiguousarray(
+            np.zeros(1) if rv_offsets is None else rv_offsets,
+            dtype=np.float64)
+        rv_jitters = np.ascontiguousarray(
+            np.zeros(rv_offsets.size) if rv_jitters is None else rv_jitters,
+            dtype=np.float64)
+
+        with self.lock:
+            self._prepare(flat)
+            model_lnlike(self.handle, self.theta, ferr_frac, rv_offsets,
+                         rv_jitters, self.terms)
+
+            return self.terms[0], self.terms[1]
+
+    def close(self):
+        with self.lock:
+            if self.handle is not None:
+                model_destroy(self.handle)
+                self.handle = None
+
+    def __del__(self):
+        self.close()
 
-    result = np.array(result)
+    def __enter__(self):
+        return self
 
-    return np.concatenate(result[:, 0]), np.concatenate(result[:, 1])
\ No newline at end of file
+    def __exit__(self, *args):
+        self.close()
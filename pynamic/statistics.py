@@ -0,0 +1,158 @@
+__author__ = 'nmearl'
+
+import numpy as np
+
+# Rows read into memory at a time
+CHUNK_SIZE = 65536
+
+
+def chunks(chain, size=CHUNK_SIZE, dropnan=True):
+    # The chain (rows, or steps of walkers as left by chain.select with
+    # flat=False) as in-memory blocks of about size rows; rows whose lnp is
+    # nan are dropped if dropnan is set
+    step = max(1, size // chain.shape[1]) if chain.ndim == 3 else size
+
+    for i in range(0, len(chain), step):
+        block = np.array(chain[i:i + step]).reshape(-1, chain.shape[-1])
+
+        if dropnan:
+            block = block[~np.isnan(block[:, 0])]
+
+        yield block
+
+
+# Running count, extrema, mean and covariance of the columns of the blocks
+# handed to add, merged block by block (Chan et al.), so they are exact
+# without holding more than one block at a time.
+class Moments(object):
+    def __init__(self, ncols):
+        self.n = 0
+        self.min = np.zeros(ncols) + np.inf
+        self.max = np.zeros(ncols) - np.inf
+        self.mean = np.zeros(ncols)
+        self.m2 = np.zeros((ncols, ncols))
+
+    def add(self, block):
+        nb = len(block)
+
+        if not nb:
+            return
+
+        mean = block.mean(axis=0)
+        resid = block - mean
+        delta = mean - self.mean
+        n = self.n + nb
+
+        self.m2 += np.dot(resid.T, resid) + \
+            np.outer(delta, delta) * (self.n * nb / float(n))
+        self.mean += delta * (nb / float(n))
+        self.min = np.minimum(self.min, block.min(axis=0))
+        self.max = np.maximum(self.max, block.max(axis=0))
+        self.n = n
+
+    @property
+    def covariance(self):
+        return self.m2 / max(self.n - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(np.diag(self.covariance))
+
+
+def moments(chain, size=CHUNK_SIZE):
+    stats = Moments(chain.shape[-1])
+
+    for block in chunks(chain, size):
+        stats.add(block)
+
+    return stats
+
+
+def _bins(lo, hi, bins, ncols):
+    lo = np.zeros(ncols) + lo
+    hi = np.zeros(ncols) + hi
+
+    return lo, hi, np.where(hi > lo, hi - lo, 1.0) / bins
+
+
+def _index(values, lo, hi, width, bins):
+    # Bin of each value, and whether it is in the range at all
+    index = np.minimum(((values - lo) / width).astype(np.int64), bins - 1)
+
+    return index, (values >= lo) & (values <= hi)
+
+
+def histogram(chain, bins, lo, hi, size=CHUNK_SIZE):
+    # Counts of each column in bins fixed bins between lo and hi (one value,
+    # or one per column); values outside are left out, as by np.histogram
+    ncols = chain.shape[-1]
+    lo, hi, width = _bins(lo, hi, bins, ncols)
+    counts = np.zeros(ncols * bins, dtype=np.int64)
+    offsets = np.arange(ncols) * bins
+
+    for block in chunks(chain, size):
+        index, inside = _index(block, lo, hi, width, bins)
+        counts += np.bincount((index + offsets)[inside],
+                              minlength=counts.size)
+
+    edges = lo[:, None] + width[:, None] * np.arange(bins + 1)
+
+    return counts.reshape(-1, bins), edges
+
+
+def quantiles(chain, q, stats=None, bins=4096, max_values=1000000,
+              size=CHUNK_SIZE):
+    # Percentiles q of each column, as np.percentile (linear interpolation)
+    # gives them. A fixed-bin histogram locates the values of each
+    # percentile; the values in those bins are then read again, so the
+    # result is exact unless there are more than max_values of them, in which
+    # case it is interpolated within the bin. Three passes over the chain
+    # (two if stats, its Moments, are given), one block at a time.
+    q = np.atleast_1d(q) / 100.0
+
+    if stats is None:
+        stats = moments(chain, size)
+
+    counts, edges = histogram(chain, bins, stats.min, stats.max, size)
+    lo, hi, width = _bins(stats.min, stats.max, bins, len(counts))
+    cum = np.cumsum(counts, axis=1)
+    cols = np.arange(len(counts))
+
+    # Ranks just below and above each percentile, the bins they fall in and
+    # the number of values before the first of them
+    rank = np.outer(q, np.zeros(len(cols)) + stats.n - 1)
+    below = np.floor(rank).astype(np.int64)
+    above = np.minimum(below + 1, stats.n - 1)
+    first = np.array([[np.searchsorted(cum[j], r[j], side='right')
+                       for j in cols] for r in below])
+    last = np.array([[np.searchsorted(cum[j], r[j], side='right')
+                      for j in cols] for r in above])
+    start = np.where(first > 0, cum[cols, np.maximum(first - 1, 0)], 0)
+
+    # Approximate values, interpolated within the bins
+    frac = (rank - start + 0.5) / np.maximum(counts[cols, first], 1)
+    result = edges[cols, first] + np.minimum(frac, 1.0) * width
+
+    exact = cum[cols, last] - start <= max_values
+
+    if not np.any(exact):
+        return result
+
+    values = [[[] for j in cols] for r in q]
+
+    for block in chunks(chain, size):
+        index, inside = _index(block, lo, hi, width, bins)
+
+        for i, j in zip(*np.nonzero(exact)):
+            keep = inside[:, j] & (index[:, j] >= first[i, j]) & \
+                (index[:, j] <= last[i, j])
+            values[i][j].append(block[keep, j])
+
+    for i, j in zip(*np.nonzero(exact)):
+        inside = np.sort(np.concatenate(values[i][j]))
+        k = below[i, j] - start[i, j]
+        upper = inside[k + above[i, j] - below[i, j]]
+        result[i, j] = inside[k] + (rank[i, j] - below[i, j]) * \
+            (upper - inside[k])
+
+    return result
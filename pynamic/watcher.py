@@ -3,6 +3,7 @@ __author__ = 'nmearl'
 import threading
 import numpy as np
 import datetime
+from pynamic import photometry
 
 
 class Progress(threading.Thread):
@@ -39,40 +40,26 @@ class Watcher(Progress):
         nbodies = int(params.get('nbodies').value)
 
         ferr_frac = params.get("ferr_frac").value
-        trv_corr = params.get("gamma_t").value
-        mrv_corr = params.get("gamma_m").value
-
-        masses = np.array([params.get('mass_{0}'.format(i)).value
-                           for i in range(nbodies)])
-        radii = np.array([params.get('radius_{0}'.format(i)).value
-                          for i in range(nbodies)])
-        fluxes = np.array([params.get('flux_{0}'.format(i)).value
-                           for i in range(nbodies)])
-        u1 = np.array([params.get('u1_{0}'.format(i)).value
-                       for i in range(nbodies)])
-        u2 = np.array([params.get('u2_{0}'.format(i)).value
-                       for i in range(nbodies)])
-        a = np.array([params.get('a_{0}'.format(i)).value
-                      for i in range(1, nbodies)])
-        e = np.array([params.get('e_{0}'.format(i)).value
-                      for i in range(1, nbodies)])
-        inc = np.array([params.get('inc_{0}'.format(i)).value
-                        for i in range(1, nbodies)])
-        om = np.array([params.get('om_{0}'.format(i)).value
-                       for i in range(1, nbodies)])
-        ln = np.array([params.get('ln_{0}'.format(i)).value
-                       for i in range(1, nbodies)])
-        ma = np.array([params.get('ma_{0}'.format(i)).value
-                       for i in range(1, nbodies)])
+        offsets = [(name, params.get(name).value if name in params.odict
+                    else 0.0)
+                   for name, jitter in self.optimizer.likelihood.instruments]
+
+        masses, radii, fluxes, u1, u2, a, e, inc, om, ln, ma = np.split(
+            params.values[params.model_index],
+            photometry.model_sections(nbodies))
 
         print('=' * 83)
         print('Likelihood: {0} | Red. Chisq: {1} | {2} | {3}'.format(
             self.maxlnp, self.optimizer.redchisq(),
             str(datetime.datetime.now().time()), ferr_frac))
         print('-' * 83)
-        print("TRES Gamma: {0} | McDonald Gamma: {1}".format(
-            trv_corr, mrv_corr
-        ))
+        print(' | '.join('{0}: {1}'.format(name, value)
+                         for name, value in offsets))
+
+        if self.optimizer.diagnostics is not None:
+            print('-' * 83)
+            print(self.optimizer.diagnostics.summary())
+
         print('-' * 83)
         print('System parameters')
         print('-' * 83)